@@ -0,0 +1,530 @@
+"""بنچمارک آفلاین BestWatchBot.
+
+سرورهای محلی aiohttp به جای TMDB، OMDB، RapidAPI، Gemini و Bot API تلگرام اجرا می‌شوند
+(با تأخیر، نرخ خطا و نرخ 429 قابل تنظیم) و توابع fetch_movies_to_cache، post_movie_job و
+ذخیره/بارگذاری main.py با اندازه‌های مختلف کاتالوگ اجرا می‌شوند. خروجی JSON شامل زمان اجرا،
+تعداد درخواست‌ها، بیشترین RSS و توقف‌های event loop است تا برای مقایسه بین نسخه‌ها ذخیره شود.
+
+مثال:
+    python bench.py --sizes 100,1000,10000 --latency 20 --error-rate 0.01 --output bench.json
+"""
+import argparse
+import asyncio
+import gc
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import re
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import aiohttp
+import psutil
+from aiohttp import web
+
+GENRES = ['Drama', 'Comedy', 'Thriller', 'Action', 'Animation', 'Documentary', 'Romance', 'Crime']
+RATINGS = ['G', 'PG', 'PG-13', 'R']
+COUNTRIES = ['United States', 'United Kingdom', 'France', 'Iran', 'Japan', 'South Korea']
+BOT_TOKEN = '123456:bench'
+POSTER_BYTES = b'\xff\xd8\xff\xe0' + b'\x00' * 2048
+
+# ----------------- سرورهای جایگزین -----------------
+def create_stub_app(catalog_size, latency, error_rate, throttle_rate, seed=42):
+    stats = {}
+    rng = random.Random(seed)
+
+    def telegram_error(status, description, retry_after=None):
+        body = {'ok': False, 'error_code': status, 'description': description}
+        if retry_after:
+            body['parameters'] = {'retry_after': retry_after}
+        return web.json_response(body, status=status)
+
+    @web.middleware
+    async def stub_middleware(request, handler):
+        service = request.path.split('/')[1]
+        if service == '_stats':
+            return await handler(request)
+        stats[service] = stats.get(service, 0) + 1
+        if latency:
+            await asyncio.sleep(rng.uniform(0.5, 1.5) * latency / 1000)
+        roll = rng.random()
+        if roll < throttle_rate:
+            if service == 'telegram':
+                return telegram_error(429, 'Too Many Requests: retry after 1', retry_after=1)
+            return web.json_response({'status_message': 'rate limited'}, status=429, headers={'Retry-After': '1'})
+        if roll < throttle_rate + error_rate:
+            if service == 'telegram':
+                return telegram_error(500, 'Internal Server Error')
+            return web.json_response({'status_message': 'stub error'}, status=500)
+        return await handler(request)
+
+    def movie_id_for(offset, index):
+        return (offset + index) % catalog_size + 1
+
+    async def discover(request):
+        query = sorted((k, v) for k, v in request.query.items() if k != 'page')
+        offset = int(hashlib.sha1(repr(query).encode()).hexdigest()[:8], 16) % catalog_size
+        page = int(request.query.get('page', 1))
+        start = (page - 1) * 20
+        results = [{'id': movie_id_for(offset, start + i)} for i in range(20) if start + i < catalog_size]
+        total_pages = min(500, math.ceil(catalog_size / 20))
+        return web.json_response({'page': page, 'results': results, 'total_pages': total_pages})
+
+    async def movie(request):
+        movie_id = int(request.match_info['movie_id'])
+        etag = f'"{movie_id}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304)
+        return web.json_response({
+            'id': movie_id,
+            # هر پنجاهمین فیلم بدون imdb_id است تا مسیر رد شدن هم اجرا شود
+            'imdb_id': None if movie_id % 50 == 0 else f"tt{movie_id:07d}",
+            'title': f"Bench Movie {movie_id}",
+            'original_title': f"Bench Movie {movie_id}",
+            'release_date': f"{1980 + movie_id % 45}-01-01",
+            'runtime': 90 + movie_id % 60,
+            'overview': f"Overview of bench movie {movie_id}. " * 8,
+            'genres': [{'name': GENRES[movie_id % len(GENRES)]}, {'name': GENRES[(movie_id // 7) % len(GENRES)]}],
+            'poster_path': f"/p{movie_id}.jpg",
+            'vote_average': 5 + movie_id % 50 / 10,
+            'vote_count': 1000 + movie_id % 5000,
+            'tagline': f"Tagline {movie_id}",
+        }, headers={'ETag': etag})
+
+    async def credits(request):
+        movie_id = int(request.match_info['movie_id'])
+        return web.json_response({
+            'cast': [{'name': f"Actor {movie_id}-{i}"} for i in range(8)],
+            'crew': [
+                {'name': f"Director {movie_id}", 'job': 'Director', 'department': 'Directing'},
+                {'name': f"Writer {movie_id}", 'job': 'Screenplay', 'department': 'Writing'},
+            ],
+        })
+
+    async def search(request):
+        title = request.query.get('query', '')
+        movie_id = int(hashlib.sha1(title.encode()).hexdigest()[:8], 16) % catalog_size + 1
+        return web.json_response({'results': [{'id': movie_id, 'title': title}]})
+
+    async def find(request):
+        imdb_id = request.match_info['imdb_id']
+        movie_id = int(imdb_id[2:]) if imdb_id[2:].isdigit() else 1
+        return web.json_response({'movie_results': [{'id': movie_id}]})
+
+    async def image(request):
+        return web.Response(body=POSTER_BYTES, content_type='image/jpeg')
+
+    async def omdb(request):
+        imdb_id = request.query.get('i', 'tt0000001')
+        number = int(imdb_id[2:]) if imdb_id[2:].isdigit() else 1
+        return web.json_response({
+            'Response': 'True',
+            'Rated': RATINGS[number % len(RATINGS)],
+            'Plot': f"Plot of bench movie {number}. " * 6,
+            'Language': 'English',
+            'Country': COUNTRIES[number % len(COUNTRIES)],
+            'Awards': f"{number % 5} wins",
+            'Metascore': str(40 + number % 60),
+            'imdbRating': f"{5 + number % 50 / 10:.1f}",
+            'imdbVotes': f"{10000 + number:,}",
+            'BoxOffice': 'N/A',
+            'Production': 'N/A',
+            'Website': 'N/A',
+            'Director': f"Director {number}",
+            'Writer': f"Writer {number}",
+            'Actors': f"Actor {number}-0, Actor {number}-1",
+        })
+
+    async def rapidapi(request):
+        return web.json_response({'status': 'OK', 'rating': 7.0})
+
+    async def gemini(request):
+        payload = await request.json()
+        text = json.dumps(payload, ensure_ascii=False)
+        if payload.get('generationConfig', {}).get('responseMimeType') == 'application/json':
+            # درخواست دسته‌ای: یک خلاصه برای هر id موجود در پرامپت
+            prompt = payload['contents'][0]['parts'][0]['text']
+            ids = [int(match) for match in re.findall(r'"id": (\d+)', prompt)]
+            answer = json.dumps([{'id': i, 'summary': f"خلاصه آزمایشی فیلم {i}."} for i in ids], ensure_ascii=False)
+        else:
+            answer = f"خلاصه آزمایشی برای {len(text)} کاراکتر ورودی."
+        return web.json_response({
+            'candidates': [{'content': {'parts': [{'text': answer}], 'role': 'model'}}],
+            'usageMetadata': {'promptTokenCount': len(text) // 4, 'candidatesTokenCount': 40, 'totalTokenCount': len(text) // 4 + 40},
+        })
+
+    async def telegram(request):
+        await request.read()
+        method = request.match_info['method']
+        if method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method in ('sendPhoto', 'sendMessage', 'editMessageText', 'sendDocument'):
+            stats['telegram_message_id'] = stats.get('telegram_message_id', 0) + 1
+            result = {
+                'message_id': stats['telegram_message_id'],
+                'date': int(time.time()),
+                'chat': {'id': -100123, 'type': 'channel'},
+            }
+            if method == 'sendPhoto':
+                result['photo'] = [{'file_id': f"photo-{result['message_id']}", 'file_unique_id': f"u{result['message_id']}",
+                                    'width': 780, 'height': 1170}]
+            else:
+                result['text'] = 'ok'
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def get_stats(request):
+        return web.json_response({k: v for k, v in stats.items() if k != 'telegram_message_id'})
+
+    async def reset_stats(request):
+        message_id = stats.get('telegram_message_id', 0)
+        stats.clear()
+        stats['telegram_message_id'] = message_id
+        return web.json_response({'ok': True})
+
+    app = web.Application(middlewares=[stub_middleware])
+    app.router.add_get('/tmdb/3/discover/movie', discover)
+    app.router.add_get('/tmdb/3/movie/{movie_id:\\d+}', movie)
+    app.router.add_get('/tmdb/3/movie/{movie_id:\\d+}/credits', credits)
+    app.router.add_get('/tmdb/3/search/movie', search)
+    app.router.add_get('/tmdb/3/find/{imdb_id}', find)
+    app.router.add_get('/img/{size}/{name}', image)
+    app.router.add_get('/omdb/', omdb)
+    app.router.add_get('/rapid/movie/{imdb_id}', rapidapi)
+    app.router.add_post('/gemini/v1beta/models/{action}', gemini)
+    app.router.add_post('/telegram/{bot}/{method}', telegram)
+    app.router.add_get('/telegram/{bot}/{method}', telegram)
+    app.router.add_get('/_stats', get_stats)
+    app.router.add_post('/_stats/reset', reset_stats)
+    return app
+
+def run_stub_server(port, config, ready):
+    async def serve():
+        runner = web.AppRunner(create_stub_app(**config), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        ready.set()
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# ----------------- اندازه‌گیری -----------------
+class LoopMonitor:
+    # تأخیر event loop را با خواب‌های کوتاه اندازه می‌گیرد و RSS فرایند را نمونه‌برداری می‌کند
+    def __init__(self, interval=0.01, stall_threshold=0.05):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.process = psutil.Process()
+        self.task = None
+
+    async def _run(self):
+        ticks = 0
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - started - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.stall_threshold:
+                self.stalls += 1
+                self.stalled_time += lag
+            ticks += 1
+            if ticks % 10 == 0:
+                self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+    def start(self):
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.stalled_time = 0.0
+        self.peak_rss = self.process.memory_info().rss
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+        return {
+            'peak_rss_mb': round(self.peak_rss / 1024 / 1024, 1),
+            'loop_stalls': self.stalls,
+            'loop_stalled_s': round(self.stalled_time, 3),
+            'max_loop_lag_ms': round(self.max_lag * 1000, 1),
+        }
+
+class FakeApplication:
+    def __init__(self):
+        self.tasks = []
+
+    def create_task(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+    async def drain(self):
+        while self.tasks:
+            await self.tasks.pop()
+
+class FakeContext:
+    def __init__(self, bot, application):
+        self.bot = bot
+        self.application = application
+        self.job = None
+        self.args = []
+
+def configure_environment(base_url, args):
+    # باید قبل از import main انجام شود چون تنظیمات هنگام import خوانده می‌شوند
+    unlimited = '1000000'
+    os.environ.update({
+        'TELEGRAM_TOKEN': BOT_TOKEN,
+        'CHANNEL_ID': '-100123',
+        'ADMIN_ID': '1',
+        'TMDB_API_KEY': 'bench',
+        'OMDB_API_KEY': 'bench',
+        'RAPIDAPI_KEY': 'bench',
+        'TMDB_API_BASE': f"{base_url}/tmdb/3",
+        'TMDB_IMAGE_BASE': f"{base_url}/img",
+        'OMDB_API_BASE': f"{base_url}/omdb",
+        'RAPIDAPI_BASE': f"{base_url}/rapid",
+        'TELEGRAM_API_BASE': f"{base_url}/telegram",
+        'GOOGLE_API_KEY': 'bench',
+        'GEMINI_API_BASE': f"{base_url}/gemini/v1beta",
+    })
+    if not args.respect_limits:
+        for name in ('TMDB', 'OMDB', 'RAPIDAPI', 'GEMINI'):
+            os.environ.setdefault(f"{name}_RATE", unlimited)
+            os.environ.setdefault(f"{name}_BURST", unlimited)
+        os.environ.setdefault('OMDB_DAILY_QUOTA', '0')
+        os.environ.setdefault('TELEGRAM_SEND_RATE', unlimited)
+        os.environ.setdefault('TELEGRAM_CHAT_INTERVAL', '0')
+
+def measure_allocation(build):
+    # حجم حافظه‌ای که ساختار ساخته شده توسط build نگه می‌دارد
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    data = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del data
+    return size
+
+def main_module():
+    return sys.modules['main']
+
+def reset_bot_state(main, workdir, size):
+    # هر اندازه با دیتابیس و کش خالی شروع می‌شود
+    main.close_store()
+    main.close_http_cache()
+    main.DB_FILE = os.path.join(workdir, f"bench-{size}.db")
+    main.HTTP_CACHE_FILE = os.path.join(workdir, f"http-cache-{size}.db")
+    main.POSTER_CACHE_DIR = os.path.join(workdir, f"posters-{size}")
+    main.CACHE_FILE = os.path.join(workdir, 'missing-movie-cache.json')
+    main.POSTED_MOVIES_FILE = os.path.join(workdir, 'missing-posted-movies.json')
+    main.CHANNELS_FILE = os.path.join(workdir, 'missing-channels.json')
+    main.meta_cache = None
+    main.poster_file_ids = None
+    main.summary_cache = None
+    main.movie_cache = {}
+    main.rejected_movies = set()
+    main.identity_index = {}
+    main.channels = main.load_channels()
+    for key in main.http_cache_stats:
+        main.http_cache_stats[key] = 0
+    main.rate_limiters = {
+        name: main.ProviderLimiter(name, rate, burst, main.DAILY_QUOTAS.get(name, 0))
+        for name, (rate, burst) in main.RATE_LIMITS.items()
+    }
+    main.circuit_breakers = {name: main.CircuitBreaker(name) for name in main.circuit_breakers}
+    main.latency_samples.clear()
+    main.telegram_sender = main.SendQueue(main.TELEGRAM_SEND_RATE, main.TELEGRAM_CHAT_INTERVAL, main.TELEGRAM_SEND_ATTEMPTS)
+    main.alert_digest = main.AlertDigest(main.ALERT_DIGEST_INTERVAL, main.ALERT_BURST)
+    for key in main.hedge_stats:
+        main.hedge_stats[key] = 0
+    main.POOL_TARGET = size
+    # چند کوئری دیسکاور شناسه‌های تکراری برمی‌گردانند؛ صفحات بیشتری لازم است
+    main.DISCOVER_PAGES = math.ceil(size / 20) * 3
+
+async def measure(name, size, coroutine_factory, stats_session, base_url):
+    await stats_session.post(f"{base_url}/_stats/reset")
+    monitor = LoopMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    outcome = await coroutine_factory()
+    # زمان نوشتن تغییرات صف شده روی دیسک هم جزو سناریو حساب می‌شود
+    await main_module().persistence_writer.flush()
+    wall_time = time.perf_counter() - started
+    loop_stats = await monitor.stop()
+    async with stats_session.get(f"{base_url}/_stats") as response:
+        requests = await response.json()
+    result = {
+        'scenario': name,
+        'titles': size,
+        'wall_time_s': round(wall_time, 3),
+        'requests': sum(requests.values()),
+        'requests_by_service': requests,
+        **loop_stats,
+        **(outcome or {}),
+    }
+    print(json.dumps(result, ensure_ascii=False), file=sys.stderr)
+    return result
+
+async def run_size(main, size, args, base_url, workdir, stats_session):
+    import telegram
+
+    reset_bot_state(main, workdir, size)
+    results = []
+
+    async def fetch_cold():
+        await main.fetch_movies_to_cache()
+        return {'cached_titles': len(main.movie_cache), 'hedge': dict(main.hedge_stats)}
+
+    async def fetch_warm():
+        # حذف فیلم‌ها از کش و پیمایش دوباره؛ پاسخ‌ها باید از کش HTTP خوانده شوند
+        for movie_id in list(main.movie_cache):
+            main.cache_remove_movie(movie_id)
+        main.store_set_meta('discover_cursor', {})
+        await main.fetch_movies_to_cache()
+        return {'cached_titles': len(main.movie_cache), 'http_cache_hit_ratio': round(main.get_http_cache_hit_ratio(), 3)}
+
+    async def post():
+        application = FakeApplication()
+        bot = telegram.Bot(BOT_TOKEN, base_url=f"{base_url}/telegram/bot")
+        async with bot:
+            context = FakeContext(bot, application)
+            await main.refill_post_queue()
+            for _ in range(args.posts):
+                await main.post_movie_job(context)
+                await application.drain()
+        return {'posts': args.posts, 'posted_total': sum(len(channel.posted) for channel in main.channels)}
+
+    async def save():
+        for movie_id, details in list(main.movie_cache.items()):
+            main.cache_put_movie(movie_id, details)
+        return {'saved_titles': len(main.movie_cache)}
+
+    async def load():
+        await main.load_cache_from_store()
+        await main.load_posted_movies_from_store()
+        await main.load_rejected_movies_from_store()
+        await main.load_identities_from_store()
+        main.rebuild_candidate_pools()
+        return {'loaded_titles': len(main.movie_cache)}
+
+    async def memory():
+        # مقایسه حافظه movie_cache با رکورد فشرده و با دیکشنری کامل قبلی (شامل متن‌های حجیم)
+        await main.persistence_writer.flush()
+        with main.store_lock:
+            rows = main.open_store().execute(
+                "SELECT m.data, t.overview, t.plot, t.tagline FROM movies m LEFT JOIN movie_text t ON t.id = m.id"
+            ).fetchall()
+
+        def build_dicts():
+            return [
+                {**json.loads(data), **dict(zip(main.MOVIE_TEXT_FIELDS, text))}
+                for data, *text in rows
+            ]
+
+        def build_records():
+            return [main.MovieRecord(json.loads(data)) for data, *_ in rows]
+
+        # کش فعلی آزاد و بعداً دوباره بارگذاری می‌شود تا رشته‌های intern شده از قبل موجود نباشند
+        main.movie_cache = {}
+        main.shared_tuples.clear()
+        dict_bytes = measure_allocation(build_dicts)
+        record_bytes = measure_allocation(build_records)
+        await main.load_cache_from_store()
+        return {
+            'memory_titles': len(rows),
+            'dict_layout_mb': round(dict_bytes / 1024 / 1024, 2),
+            'record_layout_mb': round(record_bytes / 1024 / 1024, 2),
+            'dict_bytes_per_title': dict_bytes // max(1, len(rows)),
+            'record_bytes_per_title': record_bytes // max(1, len(rows)),
+        }
+
+    for name, factory in (('fetch_cold', fetch_cold), ('fetch_warm', fetch_warm), ('post', post),
+                          ('save', save), ('load', load), ('memory', memory)):
+        results.append(await measure(name, size, factory, stats_session, base_url))
+    return results
+
+async def run_benchmarks(args, base_url, workdir):
+    configure_environment(base_url, args)
+    import main
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    results = []
+    async with aiohttp.ClientSession() as stats_session:
+        for size in args.sizes:
+            results.extend(await run_size(main, size, args, base_url, workdir, stats_session))
+    await main.close_http_session()
+    main.close_http_cache()
+    main.close_store()
+    return results
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="بنچمارک آفلاین BestWatchBot با سرورهای جایگزین محلی")
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        type=lambda value: [int(size) for size in value.split(',')],
+                        help="اندازه‌های کاتالوگ (با کاما)")
+    parser.add_argument('--posts', type=int, default=10, help="تعداد پست‌ها در سناریوی post")
+    parser.add_argument('--latency', type=float, default=20, help="میانگین تأخیر سرورهای جایگزین (میلی‌ثانیه)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="نسبت پاسخ‌های 500")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="نسبت پاسخ‌های 429")
+    parser.add_argument('--respect-limits', action='store_true', help="استفاده از محدودیت نرخ واقعی main.py")
+    parser.add_argument('--output', help="مسیر فایل JSON خروجی")
+    parser.add_argument('--verbose', action='store_true', help="نمایش لاگ‌های main.py")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    port = get_free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    config = {
+        'catalog_size': max(args.sizes),
+        'latency': args.latency,
+        'error_rate': args.error_rate,
+        'throttle_rate': args.throttle_rate,
+    }
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=run_stub_server, args=(port, config, ready), daemon=True)
+    server.start()
+    try:
+        if not ready.wait(10):
+            raise RuntimeError("سرور جایگزین اجرا نشد.")
+        with tempfile.TemporaryDirectory() as workdir:
+            results = asyncio.run(run_benchmarks(args, base_url, workdir))
+    finally:
+        server.terminate()
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': {**config, 'sizes': args.sizes, 'posts': args.posts, 'respect_limits': args.respect_limits},
+        },
+        'results': results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    print(output)
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,38 @@
 import telegram
 import asyncio
 import os
+import sys
 import json
 import logging
 import aiohttp
 import random
-import google.generativeai as genai
+import math
+import csv
+import io
+import bisect
+import unicodedata
+from array import array
+from collections import deque
+import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 from dotenv import load_dotenv
-from aiohttp import ClientTimeout
+from aiohttp import ClientTimeout, web
 import urllib.parse
 from datetime import datetime, timedelta
-from google.api_core import exceptions as google_exceptions
 import aiohttp.client_exceptions
 import re
 import certifi
+import functools
+import psutil
+import ssl
+import sqlite3
+import hashlib
+import threading
+import email.utils
+import hmac
+import httpx
+import signal
 
 # تنظیمات اولیه
 logging.basicConfig(
@@ -33,153 +50,1764 @@ GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 OMDB_API_KEY = os.getenv('OMDB_API_KEY')
 RAPIDAPI_KEY = os.getenv('RAPIDAPI_KEY')
 PORT = int(os.getenv('PORT', 8080))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL') # آدرس عمومی webhook (مثلاً https://bestwatch.onrender.com/telegram)؛ اگر نباشد Long Polling
+# توکن مخفی که تلگرام در هدر هر درخواست webhook می‌فرستد؛ پیش‌فرض از توکن بات ساخته می‌شود تا بین اجراها ثابت بماند
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or (hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest() if TELEGRAM_TOKEN else None)
+
+# آدرس پایه سرویس‌ها (برای اجرای بنچمارک با سرورهای محلی قابل تغییر است)
+TMDB_API_BASE = os.getenv('TMDB_API_BASE', 'https://api.themoviedb.org/3')
+TMDB_IMAGE_BASE = os.getenv('TMDB_IMAGE_BASE', 'https://image.tmdb.org/t/p')
+OMDB_API_BASE = os.getenv('OMDB_API_BASE', 'http://www.omdbapi.com')
+RAPIDAPI_BASE = os.getenv('RAPIDAPI_BASE', 'https://movie-details-by-imdb-id.p.rapidapi.com')
+TELEGRAM_API_BASE = os.getenv('TELEGRAM_API_BASE', 'https://api.telegram.org')
+GEMINI_API_BASE = os.getenv('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com/v1beta')
 POST_INTERVAL = int(os.getenv('POST_INTERVAL', 14400)) # 4 hours in seconds
+CHANNELS_FILE = os.getenv('CHANNELS_FILE', 'channels.json') # تعریف چند کانال؛ اگر نباشد فقط CHANNEL_ID با POST_INTERVAL
+POST_STAGGER = int(os.getenv('POST_STAGGER', 0)) # فاصله شروع زمان‌بندی کانال‌ها؛ 0 یعنی تقسیم کوتاه‌ترین بازه بین کانال‌ها
 FETCH_INTERVAL = int(os.getenv('FETCH_INTERVAL', 86400)) # 24 hours in seconds
+WARM_START = os.getenv('WARM_START', 'true').lower() == 'true' # شروع بات با داده‌های ذخیره شده و دریافت فیلم‌ها در پس‌زمینه
+DISCOVER_PAGES = int(os.getenv('DISCOVER_PAGES', 5)) # حداکثر صفحات دیسکاور در هر بار دریافت
+POOL_TARGET = int(os.getenv('POOL_TARGET', 100)) # تعداد فیلم‌های پست نشده‌ای که می‌خواهیم همیشه در کش باشند
+GENRE_COOLDOWN_POSTS = int(os.getenv('GENRE_COOLDOWN_POSTS', 3)) # تعداد پست‌های اخیر که ژانرشان جریمه می‌شود
+GENRE_COOLDOWN_FACTOR = float(os.getenv('GENRE_COOLDOWN_FACTOR', 0.3)) # ضریب احتمال برای هر تکرار ژانر اخیر
+TMDB_CONCURRENCY = int(os.getenv('TMDB_CONCURRENCY', 8)) # حداکثر درخواست همزمان جزئیات TMDB
+OMDB_CONCURRENCY = int(os.getenv('OMDB_CONCURRENCY', 4)) # حداکثر درخواست همزمان OMDB/RapidAPI
+IMPORT_CONCURRENCY = int(os.getenv('IMPORT_CONCURRENCY', 8)) # تعداد ردیف‌هایی که /addmovie همزمان پردازش می‌کند
+IMPORT_PROGRESS_INTERVAL = float(os.getenv('IMPORT_PROGRESS_INTERVAL', 15)) # فاصله به‌روزرسانی پیام پیشرفت (ثانیه)
+HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', 100)) # حداکثر کل اتصال‌های باز
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', 10)) # حداکثر اتصال به هر میزبان
+
+HTTP_CACHE_FILE = os.getenv('HTTP_CACHE_FILE', 'http_cache.db') # کش پاسخ‌های API روی دیسک
+HTTP_CACHE_MAX_BYTES = int(os.getenv('HTTP_CACHE_MAX_BYTES', 50 * 1024 * 1024)) # سقف حجم کش پاسخ‌ها
+HTTP_CACHE_TTL_DISCOVER = int(os.getenv('HTTP_CACHE_TTL_DISCOVER', 6 * 3600)) # اعتبار صفحات دیسکاور
+HTTP_CACHE_TTL_DETAILS = int(os.getenv('HTTP_CACHE_TTL_DETAILS', 30 * 86400)) # اعتبار جزئیات/بازیگران/OMDB
+HTTP_CACHE_TTL_SEARCH = int(os.getenv('HTTP_CACHE_TTL_SEARCH', 7 * 86400)) # اعتبار نتایج جستجو
+
+# پروفایل timeout هر سرویس (ثانیه)
+HTTP_TIMEOUTS = {
+    'tmdb': ClientTimeout(total=15, connect=5),
+    'omdb': ClientTimeout(total=20, connect=5),
+    'rapidapi': ClientTimeout(total=20, connect=5),
+    'telegram': ClientTimeout(total=30, connect=10),
+    'gemini': ClientTimeout(total=90, connect=10),
+    'default': ClientTimeout(total=30),
+}
+
+# محدودیت نرخ هر سرویس: (درخواست در ثانیه، حداکثر انفجار)
+RATE_LIMITS = {
+    'tmdb': (float(os.getenv('TMDB_RATE', 20)), int(os.getenv('TMDB_BURST', 20))),
+    'omdb': (float(os.getenv('OMDB_RATE', 2)), int(os.getenv('OMDB_BURST', 4))),
+    'rapidapi': (float(os.getenv('RAPIDAPI_RATE', 1)), int(os.getenv('RAPIDAPI_BURST', 2))),
+    'gemini': (float(os.getenv('GEMINI_RATE', 0.15)), int(os.getenv('GEMINI_BURST', 2))),
+}
+# سهمیه روزانه هر سرویس (0 یعنی نامحدود)؛ پلن رایگان OMDB روزانه ۱۰۰۰ درخواست است
+DAILY_QUOTAS = {
+    'omdb': int(os.getenv('OMDB_DAILY_QUOTA', 1000)),
+    'rapidapi': int(os.getenv('RAPIDAPI_DAILY_QUOTA', 0)),
+}
+POST_LOOKAHEAD = int(os.getenv('POST_LOOKAHEAD', 3)) # تعداد پست‌های آماده شده از قبل
+PREPARE_INTERVAL = int(os.getenv('PREPARE_INTERVAL', 1800)) # فاصله بررسی صف پست‌های آماده (ثانیه)
+TELEGRAM_CAPTION_LIMIT = 1024 # حداکثر طول کپشن عکس در تلگرام (به واحد UTF-16)
+TELEGRAM_CAPTION_MARGIN = 16 # حاشیه اطمینان برای تفاوت شمارش تلگرام بعد از پردازش Markdown
+TELEGRAM_PHOTO_LIMIT = 10 * 1024 * 1024 # حداکثر حجم عکس ارسالی در تلگرام
+POSTER_SIZES = [size.strip() for size in os.getenv('POSTER_SIZES', 'w780,w500').split(',')] # اندازه‌های TMDB به ترتیب اولویت
+POSTER_PREFETCH = os.getenv('POSTER_PREFETCH', 'false').lower() == 'true' # دانلود و نگهداری پوستر روی دیسک
+POSTER_CACHE_DIR = os.getenv('POSTER_CACHE_DIR', 'posters')
+POSTER_CACHE_MAX_FILES = int(os.getenv('POSTER_CACHE_MAX_FILES', 50))
+API_MAX_RETRIES = int(os.getenv('API_MAX_RETRIES', 3)) # حداکثر تلاش مجدد هر درخواست
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', 30)) # بیش از این منتظر نمی‌مانیم و کار به تعویق می‌افتد
+RETRY_BUDGET_RATIO = 0.2 # هر درخواست موفق ۰.۲ تلاش مجدد به بودجه اضافه می‌کند
+RETRY_BUDGET_MAX = 20
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5)) # خطای پشت سر هم تا باز شدن مدار سرویس
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', 60)) # بعد از این مدت یک درخواست آزمایشی ارسال می‌شود
+HEDGE_QUANTILE = float(os.getenv('HEDGE_QUANTILE', 0.95)) # اگر OMDB تا این صدک تأخیرش جواب نداد RapidAPI هم صدا زده می‌شود
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', 2.0)) # تأخیر hedge تا وقتی نمونه کافی از تأخیر OMDB نداریم
+HEDGE_GRACE_FACTOR = 2.0 # بعد از پاسخ RapidAPI، OMDB تا این ضریب از تأخیر hedge فرصت دارد وگرنه تکمیلش به بعد موکول می‌شود
+TELEGRAM_SEND_RATE = float(os.getenv('TELEGRAM_SEND_RATE', 25)) # حداکثر پیام ارسالی در ثانیه برای کل بات (سقف تلگرام ۳۰)
+TELEGRAM_CHAT_INTERVAL = float(os.getenv('TELEGRAM_CHAT_INTERVAL', 3)) # حداقل فاصله دو پیام به یک چت (کانال/گروه: ۲۰ پیام در دقیقه)
+TELEGRAM_SEND_ATTEMPTS = int(os.getenv('TELEGRAM_SEND_ATTEMPTS', 5)) # حداکثر تلاش برای خطاهای شبکه و RetryAfter
+ALERT_DIGEST_INTERVAL = float(os.getenv('ALERT_DIGEST_INTERVAL', 300)) # هشدارهای تکراری در این بازه در یک پیام خلاصه جمع می‌شوند
+ALERT_BURST = int(os.getenv('ALERT_BURST', 5)) # حداکثر هشدار متفاوت که در هر بازه فوراً ارسال می‌شود
 
-# تنظیم Gemini
+# تنظیم Gemini (درخواست‌ها مستقیم به REST API و با همان ClientSession مشترک فرستاده می‌شوند)
 if GOOGLE_API_KEY:
-    try:
-        genai.configure(api_key=GOOGLE_API_KEY)
-        # استفاده از مدل gemini-2.5-flash که جدیدتر است
-        GEMINI_MODEL = "gemini-2.5-flash"
-    except Exception as e:
-        logger.error(f"خطا در تنظیم Gemini: {e}")
-        GEMINI_MODEL = None
+    GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.5-flash')
 else:
     logger.warning("GOOGLE_API_KEY تنظیم نشده است. خلاصه فیلم توسط Gemini غیرفعال است.")
     GEMINI_MODEL = None
+SUMMARY_PROMPT_VERSION = 2 # با تغییر متن پرامپت افزایش یابد تا خلاصه‌های ذخیره شده قبلی نامعتبر شوند
+SUMMARY_BATCH_SIZE = int(os.getenv('SUMMARY_BATCH_SIZE', 5)) # تعداد فیلم در هر درخواست Gemini
+SUMMARY_PREWARM_INTERVAL = int(os.getenv('SUMMARY_PREWARM_INTERVAL', 3600)) # فاصله پیش‌تولید خلاصه‌ها (ثانیه)
+SUMMARY_TOKEN_BUDGET = int(os.getenv('SUMMARY_TOKEN_BUDGET', 50000)) # سقف توکن روزانه پیش‌تولید خلاصه‌ها (0 یعنی غیرفعال)
+SUMMARY_TOKENS_PER_MOVIE = 400 # تخمین توکن هر خلاصه برای بررسی بودجه قبل از درخواست
 
 # تنظیمات کش و دیتابیس
-CACHE_FILE = "movie_cache.json"
-POSTED_MOVIES_FILE = "posted_movies.json"
+DB_FILE = os.getenv('DB_FILE', 'bestwatch.db') # پایگاه داده اصلی (SQLite)
+PERSIST_DEBOUNCE = float(os.getenv('PERSIST_DEBOUNCE', 2.0)) # تأخیر تجمیع تغییرات قبل از نوشتن روی دیسک (ثانیه)
+CACHE_FILE = "movie_cache.json" # فایل قدیمی، فقط برای انتقال یک‌باره به دیتابیس
+POSTED_MOVIES_FILE = "posted_movies.json" # فایل قدیمی، فقط برای انتقال یک‌باره به دیتابیس
+DEFAULT_CHANNEL = 'default' # نام کانال حالت تک‌کانالی؛ تاریخچه پست‌های قبلی به این نام منتقل می‌شود
 movie_cache = {}
-posted_movies = set() # تغییر به set برای عملکرد بهتر
+channels = [] # کانال‌ها همه از یک movie_cache مشترک پست می‌گیرند
+rejected_movies = set() # فیلم‌هایی که قابل استفاده نیستند (مثلاً بدون imdb_id) تا دوباره درخواست نشوند
+identity_index = {} # نام مستعار (imdb:tt..., title:نام|سال) -> کلید اصلی فیلم (شناسه TMDB)
+
+# ----------------- رکورد فشرده فیلم -----------------
+# هر فیلم در حافظه به جای دیکشنری ~۳۰ کلیدی یک شیء با __slots__ است. مقادیر تکراری (ژانر، کشور، رده سنی،
+# امتیازها) intern می‌شوند تا بین فیلم‌ها مشترک باشند و متن‌های حجیم (overview/plot/tagline) اصلاً در حافظه
+# نمی‌مانند و فقط هنگام نیاز با load_movie_text از جدول movie_text خوانده می‌شوند. رابط آن مثل دیکشنری است (get، []، keys).
+MOVIE_FIELDS = (
+    'id', 'imdb_id', 'title', 'original_title', 'release_date', 'year', 'runtime', 'genres', 'original_language',
+    'poster_path', 'vote_average', 'vote_count', 'cast', 'directors', 'writers', 'rated', 'language', 'country',
+    'awards', 'metascore', 'imdb_rating', 'imdb_votes', 'box_office', 'production', 'website', 'director', 'writer',
+    'actors', 'rapid_rating', 'omdb_pending',
+)
+MOVIE_TEXT_FIELDS = ('overview', 'plot', 'tagline')
+# فقط فیلدهایی که بین فیلم‌ها تکرار می‌شوند intern می‌شوند؛ intern کردن مقادیر یکتا (عنوان، مسیر پوستر) فقط هزینه دارد
+MOVIE_INTERNED_FIELDS = {
+    'year', 'genres', 'original_language', 'rated', 'language', 'country', 'metascore', 'imdb_rating',
+    'cast', 'directors', 'writers', 'director', 'writer', 'box_office', 'production', 'website',
+}
+MOVIE_SHARED_TUPLE_FIELDS = {'genres'} # ترکیب‌های ژانر محدودند؛ خود tuple هم بین فیلم‌ها مشترک می‌شود
+shared_tuples = {}
+
+def compact_value(key, value):
+    interned = key in MOVIE_INTERNED_FIELDS
+    if isinstance(value, str):
+        return sys.intern(value) if interned else value
+    if isinstance(value, list):
+        value = tuple(sys.intern(item) if interned and isinstance(item, str) else item for item in value)
+        if key in MOVIE_SHARED_TUPLE_FIELDS:
+            value = shared_tuples.setdefault(value, value)
+    return value
+
+class MovieRecord:
+    __slots__ = MOVIE_FIELDS + ('extra',)
+
+    def __init__(self, details):
+        for key in MOVIE_FIELDS:
+            setattr(self, key, None)
+        self.extra = None
+        for key, value in dict(details).items():
+            if key in MOVIE_TEXT_FIELDS or value is None:
+                continue
+            if key == 'original_title' and value == self.title:
+                self.original_title = self.title # اکثر فیلم‌ها عنوان اصلی یکسان دارند
+            elif key in MOVIE_FIELD_SET:
+                setattr(self, key, compact_value(key, value))
+            else:
+                # کلیدهای ناشناخته (مثلاً از نسخه‌های قبلی) حذف نمی‌شوند
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[key] = value
+
+    def get(self, key, default=None):
+        # متن‌های حجیم اینجا خوانده نمی‌شوند (خواندن همگام از دیتابیس روی event loop)؛ فقط از load_movie_text
+        if key in MOVIE_FIELD_SET:
+            value = getattr(self, key)
+        elif key in MOVIE_TEXT_FIELDS:
+            value = None
+        else:
+            value = (self.extra or {}).get(key)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None and key not in self:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def keys(self):
+        return [key for key in MOVIE_FIELDS if getattr(self, key) is not None] + list(self.extra or ())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+MOVIE_FIELD_SET = frozenset(MOVIE_FIELDS)
 
 # ----------------- توابع ذخیره‌سازی و بارگذاری -----------------
-# ... (توابع load_cache_from_file، save_cache_to_file، load_posted_movies_from_file، save_posted_movies_to_file)
-async def load_cache_from_file():
-    global movie_cache
-    if os.path.exists(CACHE_FILE):
-        try:
-            with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-                movie_cache = json.load(f)
-            logger.info(f"حافظه کش از فایل با {len(movie_cache)} آیتم بارگذاری شد.")
-        except Exception as e:
-            logger.error(f"خطا در بارگذاری حافظه کش: {e}")
+# هر تغییر فقط همان رکورد را در SQLite (حالت WAL) به‌روزرسانی می‌کند؛
+# هزینه نوشتن به اندازه تغییر است نه به اندازه کل تاریخچه.
+store_db = None
+store_lock = threading.Lock()
 
-async def save_cache_to_file():
-    if movie_cache:
-        try:
-            with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-                json.dump(movie_cache, f, ensure_ascii=False, indent=4)
-        except Exception as e:
-            logger.error(f"خطا در ذخیره حافظه کش: {e}")
+def open_store():
+    global store_db
+    if store_db is None:
+        store_db = sqlite3.connect(DB_FILE, check_same_thread=False)
+        store_db.execute("PRAGMA journal_mode=WAL")
+        store_db.execute("PRAGMA synchronous=NORMAL")
+        store_db.executescript(
+            "CREATE TABLE IF NOT EXISTS movies ("
+            "  id TEXT PRIMARY KEY, imdb_id TEXT, data TEXT NOT NULL, updated_at REAL);"
+            "DROP INDEX IF EXISTS movies_imdb;" # جستجو با imdb_id از شاخص هویت (جدول identities) انجام می‌شود
+            "CREATE TABLE IF NOT EXISTS channel_posted ("
+            "  channel TEXT, movie_id TEXT, posted_at REAL, PRIMARY KEY (channel, movie_id));"
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"
+            "CREATE TABLE IF NOT EXISTS posters (movie_id TEXT PRIMARY KEY, file_id TEXT, updated_at REAL);"
+            "CREATE TABLE IF NOT EXISTS rejected (movie_id TEXT PRIMARY KEY, reason TEXT, updated_at REAL);"
+            "CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, summary TEXT NOT NULL, updated_at REAL);"
+            "CREATE TABLE IF NOT EXISTS movie_text (id TEXT PRIMARY KEY, overview TEXT, plot TEXT, tagline TEXT);"
+            "CREATE TABLE IF NOT EXISTS identities (alias TEXT PRIMARY KEY, movie_id TEXT NOT NULL);"
+        )
+        migrate_posted_table(store_db)
+        import_legacy_json(store_db)
+        migrate_movie_text(store_db)
+        migrate_identities(store_db)
+    return store_db
 
-async def load_posted_movies_from_file():
-    global posted_movies
-    if os.path.exists(POSTED_MOVIES_FILE):
-        try:
-            with open(POSTED_MOVIES_FILE, 'r', encoding='utf-8') as f:
-                # اطمینان از تبدیل به لیست قبل از تبدیل به ست
-                data = json.load(f)
-                if isinstance(data, list):
-                    posted_movies = set(data)
-                else:
-                    posted_movies = set()
-            logger.info(f"لیست فیلم‌های پست شده با {len(posted_movies)} آیتم بارگذاری شد.")
-        except Exception as e:
-            logger.error(f"خطا در بارگذاری لیست فیلم‌های پست شده: {e}")
+def close_store():
+    global store_db
+    with store_lock:
+        if store_db is not None:
+            store_db.close()
+            store_db = None
+
+def migrate_posted_table(db):
+    # جدول posted قدیمی (تک‌کانالی) به تاریخچه کانال پیش‌فرض منتقل می‌شود
+    if not db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'posted'").fetchone():
+        return
+    with db:
+        moved = db.execute(
+            "INSERT OR IGNORE INTO channel_posted (channel, movie_id, posted_at) SELECT ?, movie_id, posted_at FROM posted",
+            (DEFAULT_CHANNEL,)
+        ).rowcount
+        db.execute("DROP TABLE posted")
+    logger.info(f"انتقال {moved} فیلم پست شده به تاریخچه کانال {DEFAULT_CHANNEL}.")
+
+def migrate_movie_text(db):
+    # متن‌های حجیم (overview/plot/tagline) از JSON فیلم‌ها به جدول movie_text منتقل می‌شوند
+    if db.execute("SELECT 1 FROM meta WHERE key = 'movie_text_split'").fetchone():
+        return
+    moved = 0
+    with db:
+        for movie_id, data in db.execute("SELECT id, data FROM movies").fetchall():
+            details = json.loads(data)
+            text = [details.pop(key, None) for key in MOVIE_TEXT_FIELDS]
+            if any(text):
+                db.execute("INSERT OR REPLACE INTO movie_text (id, overview, plot, tagline) VALUES (?, ?, ?, ?)", (movie_id, *text))
+                db.execute("UPDATE movies SET data = ? WHERE id = ?", (json.dumps(details, ensure_ascii=False), movie_id))
+                moved += 1
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('movie_text_split', ?)", (json.dumps(time.time()),))
+    if moved:
+        logger.info(f"متن‌های حجیم {moved} فیلم به جدول movie_text منتقل شد.")
 
-async def save_posted_movies_to_file():
-    if posted_movies:
+def migrate_identities(db):
+    # ساخت شاخص هویت از فیلم‌های ذخیره شده و تبدیل imdb_id های قدیمی تاریخچه پست به شناسه TMDB
+    if db.execute("SELECT 1 FROM meta WHERE key = 'identities_built'").fetchone():
+        return
+    relinked = 0
+    with db:
+        for movie_id, data in db.execute("SELECT id, data FROM movies").fetchall():
+            for alias in identity_aliases(json.loads(data)):
+                db.execute("INSERT OR IGNORE INTO identities (alias, movie_id) VALUES (?, ?)", (alias, movie_id))
+        for channel, movie_id in db.execute("SELECT channel, movie_id FROM channel_posted WHERE movie_id LIKE 'tt%'").fetchall():
+            row = db.execute("SELECT movie_id FROM identities WHERE alias = ?", (f"imdb:{movie_id}",)).fetchone()
+            if row:
+                db.execute(
+                    "UPDATE OR REPLACE channel_posted SET movie_id = ? WHERE channel = ? AND movie_id = ?",
+                    (row[0], channel, movie_id)
+                )
+                relinked += 1
+            else:
+                # فیلم دیگر در دیتابیس نیست؛ با اولین دریافت جزئیات TMDB آن به شناسه TMDB وصل می‌شود
+                db.execute("INSERT OR IGNORE INTO identities (alias, movie_id) VALUES (?, ?)", (f"imdb:{movie_id}", movie_id))
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('identities_built', ?)", (json.dumps(time.time()),))
+    if relinked:
+        logger.info(f"{relinked} فیلم پست شده قدیمی از imdb_id به شناسه TMDB منتقل شد.")
+
+def import_legacy_json(db):
+    # انتقال یک‌باره movie_cache.json و posted_movies.json به دیتابیس
+    if db.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone():
+        return
+    movies = posted = 0
+    try:
+        with db:
+            if os.path.exists(CACHE_FILE):
+                with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                for movie_id, details in (data or {}).items():
+                    db.execute(
+                        "INSERT OR REPLACE INTO movies (id, imdb_id, data, updated_at) VALUES (?, ?, ?, ?)",
+                        (str(movie_id), details.get('imdb_id'), json.dumps(details, ensure_ascii=False), time.time())
+                    )
+                    movies += 1
+            if os.path.exists(POSTED_MOVIES_FILE):
+                with open(POSTED_MOVIES_FILE, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                for movie_id in data if isinstance(data, list) else []:
+                    db.execute(
+                        "INSERT OR IGNORE INTO channel_posted (channel, movie_id, posted_at) VALUES (?, ?, ?)",
+                        (DEFAULT_CHANNEL, str(movie_id), time.time())
+                    )
+                    posted += 1
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_imported', ?)", (json.dumps(time.time()),))
+        if movies or posted:
+            logger.info(f"انتقال فایل‌های JSON قدیمی به دیتابیس: {movies} فیلم و {posted} فیلم پست شده.")
+    except Exception as e:
+        logger.error(f"خطا در انتقال فایل‌های JSON قدیمی به دیتابیس: {e}")
+
+# ----------------- نویسنده پس‌زمینه -----------------
+# تغییرات در حافظه ثبت و با تأخیر کوتاه (PERSIST_DEBOUNCE) در یک تراکنش در thread جداگانه نوشته می‌شوند.
+# چند تغییر پشت سر هم روی یک رکورد فقط یک بار نوشته می‌شود و event loop هیچ‌وقت منتظر دیسک نمی‌ماند.
+class PersistenceWriter:
+    def __init__(self, delay):
+        self.delay = delay
+        self.pending = {}
+        self.flush_task = None
+        self.flush_lock = asyncio.Lock()
+
+    def mark(self, key, sql, params):
+        # آخرین تغییر هر رکورد برنده است و به انتهای صف منتقل می‌شود
+        self.pending.pop(key, None)
+        self.pending[key] = (sql, params)
         try:
-            with open(POSTED_MOVIES_FILE, 'w', encoding='utf-8') as f:
-                # تبدیل به لیست قبل از ذخیره
-                json.dump(list(posted_movies), f, ensure_ascii=False, indent=4)
-        except Exception as e:
-            logger.error(f"خطا در ذخیره لیست فیلم‌های پست شده: {e}")
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # خارج از event loop (مثلاً اسکریپت‌ها) مستقیم نوشته می‌شود
+            self.write(self.take())
+            return
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    def discard(self, *prefix):
+        for key in [key for key in self.pending if key[:len(prefix)] == prefix]:
+            del self.pending[key]
+
+    def take(self):
+        operations = list(self.pending.items())
+        self.pending.clear()
+        return operations
+
+    def write(self, operations):
+        if not operations:
+            return
+        with store_lock:
+            db = open_store()
+            with db:
+                for _, (sql, params) in operations:
+                    db.execute(sql, params)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delay)
+        await self.flush()
+
+    async def flush(self):
+        async with self.flush_lock:
+            operations = self.take()
+            if not operations:
+                return
+            try:
+                await asyncio.to_thread(self.write, operations)
+            except Exception as e:
+                logger.error(f"خطا در ذخیره‌سازی {len(operations)} تغییر در دیتابیس: {e}")
+                # برگرداندن تغییرات به ابتدای صف با همان کلید؛ رکوردی که در این فاصله تغییر جدیدتری دارد برگردانده نمی‌شود
+                newer, self.pending = self.pending, {}
+                for key, operation in operations:
+                    if key not in newer:
+                        self.pending[key] = operation
+                self.pending.update(newer)
+                # flush_task معمولاً همین تسک در حال اجراست و done نیست، پس تلاش دوباره بدون شرط زمان‌بندی می‌شود
+                self.flush_task = asyncio.create_task(self._flush_later())
+
+persistence_writer = PersistenceWriter(PERSIST_DEBOUNCE)
+meta_cache = None
+poster_file_ids = None
+summary_cache = None # فقط خلاصه‌های مدل و نسخه پرامپت فعلی
+
+def store_put_movie(movie_id, details):
+    data = dict(details)
+    text = [data.pop(key, None) for key in MOVIE_TEXT_FIELDS]
+    persistence_writer.mark(
+        ('movies', str(movie_id)),
+        "INSERT OR REPLACE INTO movies (id, imdb_id, data, updated_at) VALUES (?, ?, ?, ?)",
+        (str(movie_id), data.get('imdb_id'), json.dumps(data, ensure_ascii=False), time.time())
+    )
+    if any(text):
+        # متن‌هایی که در این به‌روزرسانی نیامده‌اند (مثلاً overview هنگام تکمیل OMDB) حفظ می‌شوند
+        persistence_writer.mark(
+            ('movie_text', str(movie_id), tuple(value is not None for value in text)),
+            "INSERT INTO movie_text (id, overview, plot, tagline) VALUES (?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET "
+            "overview = coalesce(excluded.overview, overview), plot = coalesce(excluded.plot, plot), "
+            "tagline = coalesce(excluded.tagline, tagline)",
+            (str(movie_id), *text)
+        )
+
+def store_delete_movie(movie_id):
+    persistence_writer.mark(('movies', str(movie_id)), "DELETE FROM movies WHERE id = ?", (str(movie_id),))
+    persistence_writer.discard('movie_text', str(movie_id))
+    persistence_writer.mark(('movie_text', str(movie_id)), "DELETE FROM movie_text WHERE id = ?", (str(movie_id),))
+
+def store_get_movie_text(movie_id):
+    with store_lock:
+        row = open_store().execute(
+            "SELECT overview, plot, tagline FROM movie_text WHERE id = ?", (str(movie_id),)
+        ).fetchone()
+    return dict(zip(MOVIE_TEXT_FIELDS, row)) if row else {}
+
+async def load_movie_text(movie_id):
+    # متن‌های حجیم فقط هنگام ساخت کپشن از دیتابیس خوانده می‌شوند (بعد از نوشتن تغییرات در صف)
+    await persistence_writer.flush()
+    try:
+        return await asyncio.to_thread(store_get_movie_text, movie_id)
+    except Exception as e:
+        logger.error(f"خطا در خواندن متن فیلم {movie_id}: {e}")
+        return {}
+
+def store_add_posted(channel, movie_id):
+    persistence_writer.mark(
+        ('channel_posted', channel, str(movie_id)),
+        "INSERT OR REPLACE INTO channel_posted (channel, movie_id, posted_at) VALUES (?, ?, ?)",
+        (channel, str(movie_id), time.time())
+    )
+
+def store_relink_posted(channel, old_id, new_id):
+    persistence_writer.mark(
+        ('channel_posted', channel, old_id),
+        "UPDATE OR REPLACE channel_posted SET movie_id = ? WHERE channel = ? AND movie_id = ?",
+        (new_id, channel, old_id)
+    )
+
+def store_set_identity(alias, movie_id):
+    persistence_writer.mark(
+        ('identities', alias),
+        "INSERT OR REPLACE INTO identities (alias, movie_id) VALUES (?, ?)",
+        (alias, movie_id)
+    )
+
+def store_clear_posted(channel):
+    persistence_writer.discard('channel_posted', channel)
+    persistence_writer.mark(('channel_posted', channel, '*'), "DELETE FROM channel_posted WHERE channel = ?", (channel,))
+
+def read_meta_table():
+    with store_lock:
+        rows = open_store().execute("SELECT key, value FROM meta").fetchall()
+    return {key: json.loads(value) for key, value in rows}
+
+def read_poster_table():
+    with store_lock:
+        return dict(open_store().execute("SELECT movie_id, file_id FROM posters").fetchall())
+
+def summary_key_suffix():
+    return f"|{GEMINI_MODEL}|v{SUMMARY_PROMPT_VERSION}"
+
+def summary_key(title, year):
+    return f"{title}|{year}{summary_key_suffix()}"
+
+def read_summary_table():
+    suffix = summary_key_suffix()
+    with store_lock:
+        db = open_store()
+        rows = db.execute("SELECT key, summary FROM summaries WHERE substr(key, -?) = ?", (len(suffix), suffix)).fetchall()
+        # خلاصه‌های مدل یا نسخه پرامپت قبلی دیگر استفاده نمی‌شوند (در همین thread و زیر همان قفل حذف می‌شوند)
+        with db:
+            db.execute("DELETE FROM summaries WHERE substr(key, -?) != ?", (len(suffix), suffix))
+    return dict(rows)
+
+def store_get_meta(key, default=None):
+    global meta_cache
+    if meta_cache is None:
+        meta_cache = read_meta_table()
+    return meta_cache.get(key, default)
+
+def store_set_meta(key, value):
+    global meta_cache
+    if meta_cache is None:
+        meta_cache = read_meta_table()
+    meta_cache[key] = value
+    persistence_writer.mark(
+        ('meta', key),
+        "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+        (key, json.dumps(value, ensure_ascii=False))
+    )
+
+def store_get_poster_file_id(movie_id):
+    global poster_file_ids
+    if poster_file_ids is None:
+        poster_file_ids = read_poster_table()
+    return poster_file_ids.get(str(movie_id))
+
+def store_get_summary(key):
+    global summary_cache
+    if summary_cache is None:
+        summary_cache = read_summary_table()
+    return summary_cache.get(key)
+
+def store_set_summary(key, summary):
+    global summary_cache
+    if summary_cache is None:
+        summary_cache = read_summary_table()
+    summary_cache[key] = summary
+    persistence_writer.mark(
+        ('summaries', key),
+        "INSERT OR REPLACE INTO summaries (key, summary, updated_at) VALUES (?, ?, ?)",
+        (key, summary, time.time())
+    )
+
+def store_set_poster_file_id(movie_id, file_id):
+    global poster_file_ids
+    if poster_file_ids is None:
+        poster_file_ids = read_poster_table()
+    poster_file_ids[str(movie_id)] = file_id
+    persistence_writer.mark(
+        ('posters', str(movie_id)),
+        "INSERT OR REPLACE INTO posters (movie_id, file_id, updated_at) VALUES (?, ?, ?)",
+        (str(movie_id), file_id, time.time())
+    )
+
+# ----------------- مخزن فیلم‌های قابل انتخاب -----------------
+# فیلم‌های پست نشده همراه با وزن‌شان در یک درخت Fenwick نگه داشته می‌شوند:
+# افزودن/حذف O(log n)، نمونه‌برداری وزن‌دار O(log n)، بدون ساختن دوباره لیست در هر پست.
+class CandidatePool:
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+        self.weights = []
+        self.genres = []
+        self.tree = [0.0]
+        self.reserved = set() # فیلم‌هایی که در صف پست‌های آماده هستند
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, movie_id):
+        return movie_id in self.positions
+
+    def _tree_add(self, position, delta):
+        i = position + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def _rebuild_tree(self, capacity):
+        self.tree = [0.0] * (capacity + 1)
+        for position, weight in enumerate(self.weights):
+            self._tree_add(position, weight)
+
+    def total_weight(self):
+        total, i = 0.0, len(self.ids)
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def add(self, movie_id, weight, genres=()):
+        if movie_id in self.reserved:
+            return
+        weight = max(weight, 0.01)
+        if movie_id in self.positions:
+            position = self.positions[movie_id]
+            self._tree_add(position, weight - self.weights[position])
+            self.weights[position] = weight
+            self.genres[position] = tuple(genres)
+            return
+        self.positions[movie_id] = len(self.ids)
+        self.ids.append(movie_id)
+        self.weights.append(weight)
+        self.genres.append(tuple(genres))
+        if len(self.ids) >= len(self.tree):
+            self._rebuild_tree(len(self.tree) * 2)
+        else:
+            self._tree_add(len(self.ids) - 1, weight)
+
+    def remove(self, movie_id):
+        position = self.positions.pop(movie_id, None)
+        if position is None:
+            return
+        last = len(self.ids) - 1
+        self._tree_add(position, -self.weights[position])
+        if position != last:
+            # جابجایی آخرین عنصر به جای عنصر حذف شده
+            last_id, last_weight = self.ids[last], self.weights[last]
+            self._tree_add(last, -last_weight)
+            self._tree_add(position, last_weight)
+            self.ids[position], self.weights[position], self.genres[position] = last_id, last_weight, self.genres[last]
+            self.positions[last_id] = position
+        self.ids.pop()
+        self.weights.pop()
+        self.genres.pop()
+
+    def reserve(self, movie_id):
+        self.remove(movie_id)
+        self.reserved.add(movie_id)
+
+    def release(self, movie_id):
+        self.reserved.discard(movie_id)
+
+    def clear(self):
+        self.ids, self.positions, self.weights, self.genres = [], {}, [], []
+        self.tree = [0.0]
+
+    def _find(self, target):
+        # پیدا کردن اولین موقعیتی که مجموع پیشوندی آن از target بیشتر است
+        position, step = 0, 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            nxt = position + step
+            if nxt < len(self.tree) and self.tree[nxt] <= target:
+                target -= self.tree[nxt]
+                position = nxt
+            step >>= 1
+        return min(position, len(self.ids) - 1)
+
+    def sample(self, accept=None, attempts=20):
+        # نمونه‌برداری وزن‌دار؛ accept(genres) احتمال پذیرش را برای اعمال جریمه ژانر برمی‌گرداند
+        if not self.ids:
+            return None
+        best_id, best_score = None, -1.0
+        for _ in range(attempts):
+            position = self._find(random.random() * self.total_weight())
+            score = accept(self.genres[position]) if accept else 1.0
+            if random.random() < score:
+                return self.ids[position]
+            if score > best_score:
+                best_id, best_score = self.ids[position], score
+        return best_id
+
+# ----------------- تاریخچه پست‌ها -----------------
+# شناسه‌های TMDB پست شده به صورت آرایه مرتب از عدد صحیح (۸ بایت برای هر فیلم به جای یک رشته در set) نگه داشته
+# و با جستجوی دودویی بررسی می‌شوند؛ شناسه‌های غیرعددی قدیمی (imdb_id هایی که هنوز وصل نشده‌اند) در set کوچک جدا هستند.
+class PostedHistory:
+    def __init__(self, movie_ids=()):
+        movie_ids = [str(movie_id) for movie_id in movie_ids]
+        self.ids = array('q', sorted({int(movie_id) for movie_id in movie_ids if movie_id.isdigit()}))
+        self.legacy = {movie_id for movie_id in movie_ids if not movie_id.isdigit()}
+
+    def __len__(self):
+        return len(self.ids) + len(self.legacy)
+
+    def __iter__(self):
+        yield from map(str, self.ids)
+        yield from self.legacy
+
+    def __contains__(self, movie_id):
+        movie_id = str(movie_id)
+        if not movie_id.isdigit():
+            return movie_id in self.legacy
+        value = int(movie_id)
+        position = bisect.bisect_left(self.ids, value)
+        return position < len(self.ids) and self.ids[position] == value
+
+    def add(self, movie_id):
+        movie_id = str(movie_id)
+        if movie_id in self:
+            return
+        if movie_id.isdigit():
+            bisect.insort(self.ids, int(movie_id))
+        else:
+            self.legacy.add(movie_id)
+
+    def discard(self, movie_id):
+        movie_id = str(movie_id)
+        if not movie_id.isdigit():
+            self.legacy.discard(movie_id)
+        elif movie_id in self:
+            del self.ids[bisect.bisect_left(self.ids, int(movie_id))]
+
+    def clear(self):
+        self.ids = array('q')
+        self.legacy.clear()
+
+# ----------------- کانال‌ها -----------------
+# هر کانال زمان‌بندی، فیلتر، تاریخچه پست، مخزن انتخاب و صف پست‌های آماده خودش را دارد
+# ولی همه از یک movie_cache مشترک می‌خوانند؛ یک بار دریافت و تکمیل اطلاعات برای همه کانال‌ها کافی است.
+class Channel:
+    def __init__(self, name, chat_id, interval, filters=None, offset=None):
+        self.name = name
+        self.chat_id = chat_id
+        self.interval = interval
+        self.offset = offset
+        self.filters = filters or {}
+        self.posted = PostedHistory()
+        self.pool = CandidatePool()
+        self.recent_genres = deque(maxlen=GENRE_COOLDOWN_POSTS)
+        self.prepared = deque()
+        self.prepare_lock = asyncio.Lock()
+
+    def meta_key(self, key):
+        # کلیدهای کانال پیش‌فرض همان کلیدهای حالت تک‌کانالی هستند
+        return key if self.name == DEFAULT_CHANNEL else f"{key}:{self.name}"
+
+    def matches(self, details):
+        filters = self.filters
+        genres = set(details.get('genres') or [])
+        if filters.get('genres') and not genres & set(filters['genres']):
+            return False
+        if genres & set(filters.get('exclude_genres', [])):
+            return False
+        if filters.get('languages') and details.get('original_language') not in filters['languages']:
+            return False
+        if filters.get('countries'):
+            country = details.get('country') or ''
+            if not any(name in country for name in filters['countries']):
+                return False
+        rating = parse_number(details.get('imdb_rating')) or parse_number(details.get('vote_average')) or 0.0
+        if rating < filters.get('min_rating', 0):
+            return False
+        year = parse_number(details.get('year')) or 0
+        if year < filters.get('min_year', 0) or year > filters.get('max_year', 9999):
+            return False
+        return True
+
+    def wants(self, movie_id, details):
+        return movie_id not in self.posted and self.matches(details)
+
+CHANNEL_FILTER_KEYS = ('genres', 'exclude_genres', 'languages', 'countries', 'min_rating', 'min_year', 'max_year')
+
+def load_channels():
+    # خواندن channels.json؛ در نبود آن حالت تک‌کانالی با CHANNEL_ID و POST_INTERVAL
+    if not os.path.exists(CHANNELS_FILE):
+        return [Channel(DEFAULT_CHANNEL, CHANNEL_ID, POST_INTERVAL)] if CHANNEL_ID else []
+    try:
+        with open(CHANNELS_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except Exception as e:
+        logger.error(f"خطا در خواندن {CHANNELS_FILE}: {e}")
+        return []
+
+    loaded = []
+    for entry in config if isinstance(config, list) else config.get('channels', []):
+        name = str(entry.get('name') or entry.get('chat_id') or '')
+        if not entry.get('chat_id') or any(channel.name == name for channel in loaded):
+            logger.error(f"تعریف کانال نامعتبر یا تکراری در {CHANNELS_FILE}: {entry}")
+            continue
+        filters = {key: entry[key] for key in CHANNEL_FILTER_KEYS if key in entry}
+        loaded.append(Channel(name, entry['chat_id'], int(entry.get('interval', POST_INTERVAL)), filters, entry.get('offset')))
+        # کوئری‌های دیسکاور مخصوص کانال (مثلاً زبان یا ژانر خاص) به کوئری‌های مشترک اضافه می‌شوند
+        for query_name, query in (entry.get('discover') or {}).items():
+            DISCOVER_QUERIES[f"{name}:{query_name}"] = query
+    logger.info(f"{len(loaded)} کانال از {CHANNELS_FILE} بارگذاری شد: {', '.join(channel.name for channel in loaded)}")
+    return loaded
+
+def get_channel(name=None):
+    if name is None:
+        return channels[0] if channels else None
+    return next((channel for channel in channels if channel.name == name), None)
+
+def channel_start_offsets():
+    # پخش کردن زمان اولین ارسال کانال‌ها تا ارسال‌ها همزمان نشوند
+    if not channels:
+        return []
+    stagger = POST_STAGGER or min(channel.interval for channel in channels) / len(channels)
+    return [channel.offset if channel.offset is not None else i * stagger for i, channel in enumerate(channels)]
+
+def parse_number(value):
+    try:
+        return float(str(value).replace(',', ''))
+    except (TypeError, ValueError):
+        return None
+
+def movie_weight(details):
+    # وزن بر اساس امتیاز IMDb (یا TMDB) و تعداد رای‌ها
+    rating = parse_number(details.get('imdb_rating')) or parse_number(details.get('vote_average')) or 5.0
+    votes = parse_number(details.get('vote_count')) or parse_number(details.get('imdb_votes')) or 0.0
+    return (rating / 10) ** 3 * math.log10(votes + 10)
+
+def genre_acceptance(channel, genres):
+    # هر پست اخیر کانال با ژانر مشترک، احتمال انتخاب را کم می‌کند
+    repeats = sum(1 for previous in channel.recent_genres if set(previous) & set(genres))
+    return GENRE_COOLDOWN_FACTOR ** repeats
+
+def pick_candidate(channel):
+    movie_id = channel.pool.sample(accept=functools.partial(genre_acceptance, channel))
+    if movie_id is not None:
+        channel.pool.reserve(movie_id)
+    return movie_id
+
+def return_candidate(channel, movie_id):
+    # برگرداندن فیلمی که ارسالش ناموفق بود به مخزن کانال
+    channel.pool.release(movie_id)
+    details = movie_cache.get(movie_id)
+    if details and channel.wants(movie_id, details):
+        channel.pool.add(movie_id, movie_weight(details), details.get('genres', []))
+
+def record_posted_genres(channel, details):
+    channel.recent_genres.append(tuple(details.get('genres', [])))
+    store_set_meta(channel.meta_key('recent_genres'), [list(genres) for genres in channel.recent_genres])
+
+def rebuild_candidate_pool(channel):
+    channel.pool.clear()
+    for movie_id, details in movie_cache.items():
+        if channel.wants(movie_id, details):
+            channel.pool.add(movie_id, movie_weight(details), details.get('genres', []))
+    channel.recent_genres.clear()
+    channel.recent_genres.extend(
+        tuple(genres) for genres in store_get_meta(channel.meta_key('recent_genres'), [])[-GENRE_COOLDOWN_POSTS:]
+    )
+    logger.info(f"مخزن انتخاب کانال {channel.name} با {len(channel.pool)} فیلم ساخته شد.")
+
+def rebuild_candidate_pools():
+    for channel in channels:
+        rebuild_candidate_pool(channel)
+
+def reject_movie(movie_id, reason):
+    movie_id = str(movie_id)
+    rejected_movies.add(movie_id)
+    persistence_writer.mark(
+        ('rejected', movie_id),
+        "INSERT OR REPLACE INTO rejected (movie_id, reason, updated_at) VALUES (?, ?, ?)",
+        (movie_id, reason, time.time())
+    )
+
+# ----------------- شاخص هویت فیلم‌ها -----------------
+# کلید اصلی هر فیلم شناسه TMDB (رشته) است. imdb_id و نام/سال نرمال شده به آن نگاشت می‌شوند تا یک فیلم
+# با هر شناسه‌ای که برسد (دیسکاور، /addmovie، تاریخچه قدیمی) قبل از درخواست شبکه شناخته شود.
+def normalize_title(title):
+    title = unicodedata.normalize('NFKD', str(title))
+    title = ''.join(char for char in title if not unicodedata.combining(char)).casefold()
+    return re.sub(r'[\W_]+', ' ', title).strip()
+
+def title_alias(title, year):
+    title = normalize_title(title or '')
+    return f"title:{title}|{str(year or '')[:4]}" if title else None
+
+def identity_aliases(details):
+    aliases = []
+    if details.get('imdb_id'):
+        aliases.append(f"imdb:{details['imdb_id']}")
+    year = details.get('year') or (details.get('release_date') or '')[:4]
+    for title in (details.get('title'), details.get('original_title')):
+        alias = title_alias(title, year)
+        if alias and alias not in aliases:
+            aliases.append(alias)
+    return aliases
+
+def set_identity(alias, movie_id):
+    if identity_index.get(alias) != movie_id:
+        identity_index[alias] = movie_id
+        store_set_identity(alias, movie_id)
+
+def index_movie(movie_id, details):
+    # اولین فیلم برای هر نام/سال برنده است؛ imdb_id همیشه به شناسه TMDB اشاره می‌کند
+    for alias in identity_aliases(details):
+        if alias.startswith('imdb:') or alias not in identity_index:
+            set_identity(alias, movie_id)
+
+def resolve_identity(tmdb_id=None, imdb_id=None, title=None, year=None):
+    if tmdb_id:
+        return str(tmdb_id)
+    if imdb_id and f"imdb:{imdb_id}" in identity_index:
+        return identity_index[f"imdb:{imdb_id}"]
+    alias = title_alias(title, year)
+    return identity_index.get(alias) if alias else None
+
+def relink_posted(old_id, new_id):
+    # شناسه قدیمی (imdb_id) در تاریخچه همه کانال‌ها با شناسه TMDB جایگزین می‌شود
+    for channel in channels:
+        if old_id in channel.posted:
+            channel.posted.discard(old_id)
+            channel.posted.add(new_id)
+            store_relink_posted(channel.name, old_id, new_id)
+    set_identity(f"imdb:{old_id}", new_id)
+    logger.info(f"فیلم پست شده {old_id} به شناسه TMDB {new_id} وصل شد.")
+
+def is_posted_anywhere(movie_id):
+    return any(movie_id in channel.posted for channel in channels)
+
+def is_known_movie(movie_id):
+    movie_id = str(movie_id)
+    return movie_id in movie_cache or movie_id in rejected_movies or is_posted_anywhere(movie_id)
+
+def cache_put_movie(movie_id, details):
+    movie_id = str(movie_id)
+    record = details if isinstance(details, MovieRecord) else MovieRecord(details)
+    movie_cache[movie_id] = record
+    index_movie(movie_id, record)
+    # با تکمیل اطلاعات (مثلاً کشور از OMDB) ممکن است فیلم وارد فیلتر کانالی شود یا از آن خارج شود
+    for channel in channels:
+        if channel.wants(movie_id, record):
+            channel.pool.add(movie_id, movie_weight(record), record.get('genres', []))
+        else:
+            channel.pool.remove(movie_id)
+    store_put_movie(movie_id, details)
+
+def cache_remove_movie(movie_id):
+    movie_id = str(movie_id)
+    movie_cache.pop(movie_id, None)
+    for channel in channels:
+        channel.pool.remove(movie_id)
+        channel.pool.release(movie_id)
+    store_delete_movie(movie_id)
+
+def mark_posted(channel, movie_id):
+    movie_id = str(movie_id)
+    channel.posted.add(movie_id)
+    channel.pool.remove(movie_id)
+    channel.pool.release(movie_id)
+    store_add_posted(channel.name, movie_id)
+
+def retire_posted_movie(movie_id):
+    # فیلم فقط وقتی از کش حذف می‌شود که همه کانال‌هایی که فیلترشان با آن جور است پستش کرده باشند
+    details = movie_cache.get(movie_id)
+    if details is not None and not any(channel.wants(movie_id, details) for channel in channels):
+        cache_remove_movie(movie_id)
+
+def reset_posted(channel):
+    channel.posted.clear()
+    store_clear_posted(channel.name)
+    rebuild_candidate_pool(channel)
+
+def read_movies_table():
+    with store_lock:
+        rows = open_store().execute("SELECT id, data FROM movies").fetchall()
+    return {movie_id: MovieRecord(json.loads(data)) for movie_id, data in rows}
+
+def read_id_table(table):
+    with store_lock:
+        rows = open_store().execute(f"SELECT movie_id FROM {table}").fetchall()
+    return {row[0] for row in rows}
+
+def read_posted_table():
+    posted = {}
+    with store_lock:
+        rows = open_store().execute("SELECT channel, movie_id FROM channel_posted").fetchall()
+    for channel, movie_id in rows:
+        posted.setdefault(channel, []).append(movie_id)
+    return {channel: PostedHistory(movie_ids) for channel, movie_ids in posted.items()}
+
+def read_identity_table():
+    with store_lock:
+        return dict(open_store().execute("SELECT alias, movie_id FROM identities").fetchall())
+
+# بارگذاری‌ها (خواندن و parse کردن JSON) در thread جداگانه اجرا می‌شوند
+async def load_cache_from_store():
+    global movie_cache
+    try:
+        movie_cache = await asyncio.to_thread(read_movies_table)
+        logger.info(f"حافظه کش از دیتابیس با {len(movie_cache)} آیتم بارگذاری شد.")
+    except Exception as e:
+        logger.error(f"خطا در بارگذاری حافظه کش: {e}")
+
+async def load_rejected_movies_from_store():
+    global rejected_movies
+    try:
+        rejected_movies = await asyncio.to_thread(read_id_table, 'rejected')
+    except Exception as e:
+        logger.error(f"خطا در بارگذاری لیست فیلم‌های رد شده: {e}")
+
+async def load_identities_from_store():
+    global identity_index
+    try:
+        identity_index = await asyncio.to_thread(read_identity_table)
+        logger.info(f"شاخص هویت فیلم‌ها با {len(identity_index)} نام مستعار بارگذاری شد.")
+    except Exception as e:
+        logger.error(f"خطا در بارگذاری شاخص هویت فیلم‌ها: {e}")
+
+async def load_posted_movies_from_store():
+    try:
+        posted = await asyncio.to_thread(read_posted_table)
+        for channel in channels:
+            channel.posted = posted.get(channel.name) or PostedHistory()
+            logger.info(f"لیست فیلم‌های پست شده کانال {channel.name} با {len(channel.posted)} آیتم بارگذاری شد.")
+    except Exception as e:
+        logger.error(f"خطا در بارگذاری لیست فیلم‌های پست شده: {e}")
+
+async def load_meta_from_store():
+    global meta_cache, poster_file_ids, summary_cache
+    try:
+        meta_cache = await asyncio.to_thread(read_meta_table)
+        poster_file_ids = await asyncio.to_thread(read_poster_table)
+        summary_cache = await asyncio.to_thread(read_summary_table)
+    except Exception as e:
+        logger.error(f"خطا در بارگذاری تنظیمات ذخیره شده: {e}")
 
 # ----------------- توابع کمکی -----------------
 # ... (توابع send_admin_alert، make_api_request، post_api_request، generate_summary)
 async def send_admin_alert(bot, message):
-    if ADMIN_ID and bot:
+    # بدون bot هم از بات صف ارسال استفاده می‌شود؛ هشدارهای تکراری در خلاصه دوره‌ای جمع می‌شوند
+    if ADMIN_ID and alert_digest.admit(message):
         try:
-            await bot.send_message(
-                chat_id=ADMIN_ID,
-                text=message
-            )
+            await telegram_sender.send('send_message', ADMIN_ID, bot=bot, text=message)
         except Exception as e:
             logger.error(f"خطا در ارسال پیام ادمین: {e}")
 
-async def make_api_request(url, params=None, headers=None, session=None, timeout=30):
-    if session is None:
-        session = aiohttp.ClientSession(timeout=ClientTimeout(total=timeout))
-        should_close_session = True
-    else:
-        should_close_session = False
-    
-    try:
-        async with session.get(url, params=params, headers=headers) as response:
-            if response.status == 200:
-                return await response.json()
-            else:
-                logger.error(f"خطا در درخواست API به {url} (کد: {response.status}): {await response.text()}")
-                return None
-    except aiohttp.client_exceptions.ClientConnectorError as e:
-        logger.error(f"خطای اتصال SSL/DNS در درخواست به {url}: {e}. بررسی فایل certifi.")
+# ----------------- متریک‌ها -----------------
+# متریک‌ها در حافظه جمع می‌شوند و از /metrics (فرمت Prometheus) و /health (JSON) روی PORT خوانده می‌شوند.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+JOB_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900)
+process_info = psutil.Process()
+started_at_monotonic = time.monotonic()
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, label, value):
+        counts, total = self.series.get(label, ([0] * len(self.buckets), [0.0, 0]))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        total[0] += value
+        total[1] += 1
+        self.series[label] = (counts, total)
+
+    def render(self, name, label_name):
+        lines = []
+        for label, (counts, (total, count)) in sorted(self.series.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{name}_bucket{{{label_name}="{label}",le="{bound}"}} {bucket_count}')
+            lines.append(f'{name}_bucket{{{label_name}="{label}",le="+Inf"}} {count}')
+            lines.append(f'{name}_sum{{{label_name}="{label}"}} {total:.6f}')
+            lines.append(f'{name}_count{{{label_name}="{label}"}} {count}')
+        return lines
+
+upstream_latency = Histogram(LATENCY_BUCKETS)
+upstream_errors = {}
+job_durations = Histogram(JOB_BUCKETS)
+enrichment_latency = Histogram(LATENCY_BUCKETS)
+hedge_stats = {'fired': 0, 'secondary_first': 0, 'primary_deferred': 0}
+post_results = {'sent': 0, 'failed': 0}
+send_stats = {'sent': 0, 'retried': 0, 'throttled': 0, 'uncertain': 0, 'failed': 0, 'alerts_coalesced': 0}
+event_loop_lag = {'last': 0.0, 'max': 0.0}
+latency_samples = {} # تأخیر آخرین درخواست‌های موفق هر سرویس برای محاسبه صدک
+startup_stats = {'ready_seconds': None, 'mode': None} # زمان از شروع پروسه تا اولین poll (یا ثبت webhook)
+
+def record_upstream_request(provider, seconds, status=None, error=None):
+    upstream_latency.observe(provider, seconds)
+    if status in (200, 304):
+        latency_samples.setdefault(provider, deque(maxlen=200)).append(seconds)
+    reason = error or (None if status in (200, 304) else f"http_{status}")
+    if reason:
+        upstream_errors[(provider, reason)] = upstream_errors.get((provider, reason), 0) + 1
+
+def get_latency_quantile(provider, quantile, default=None):
+    samples = latency_samples.get(provider)
+    if not samples or len(samples) < 20:
+        return default
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+def track_job(name):
+    # ثبت مدت اجرای کارهای زمان‌بندی شده
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                job_durations.observe(name, time.monotonic() - started)
+        return wrapper
+    return decorator
+
+def record_bot_ready(mode):
+    # از زمان ساخته شدن پروسه، تا import ها و بارگذاری دیتابیس هم حساب شوند
+    startup_stats['ready_seconds'] = round(time.time() - process_info.create_time(), 2)
+    startup_stats['mode'] = mode
+    logger.info(f"بات {startup_stats['ready_seconds']} ثانیه پس از شروع پروسه آماده دریافت آپدیت شد ({mode}).")
+
+async def monitor_event_loop(interval=1.0):
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.monotonic() - started - interval)
+        event_loop_lag['last'] = lag
+        event_loop_lag['max'] = max(event_loop_lag['max'], lag)
+
+def render_metrics():
+    lines = [
+        "# HELP bestwatch_upstream_request_seconds Upstream request latency.",
+        "# TYPE bestwatch_upstream_request_seconds histogram",
+        *upstream_latency.render('bestwatch_upstream_request_seconds', 'provider'),
+        "# HELP bestwatch_enrichment_seconds OMDB/RapidAPI enrichment stage duration per title.",
+        "# TYPE bestwatch_enrichment_seconds histogram",
+        *enrichment_latency.render('bestwatch_enrichment_seconds', 'stage'),
+        "# HELP bestwatch_upstream_errors_total Failed upstream requests.",
+        "# TYPE bestwatch_upstream_errors_total counter",
+    ]
+    for (provider, reason), count in sorted(upstream_errors.items()):
+        lines.append(f'bestwatch_upstream_errors_total{{provider="{provider}",reason="{reason}"}} {count}')
+    lines += [
+        "# HELP bestwatch_job_duration_seconds Scheduled job run duration.",
+        "# TYPE bestwatch_job_duration_seconds histogram",
+        *job_durations.render('bestwatch_job_duration_seconds', 'job'),
+        "# HELP bestwatch_posts_total Channel posts by result.",
+        "# TYPE bestwatch_posts_total counter",
+    ]
+    lines += [f'bestwatch_posts_total{{result="{result}"}} {count}' for result, count in post_results.items()]
+    lines += [
+        "# HELP bestwatch_telegram_send_events_total Outbound Telegram send queue events.",
+        "# TYPE bestwatch_telegram_send_events_total counter",
+    ]
+    lines += [f'bestwatch_telegram_send_events_total{{event="{event}"}} {count}' for event, count in send_stats.items()]
+    lines += [
+        "# HELP bestwatch_hedge_events_total Hedged OMDB/RapidAPI request events.",
+        "# TYPE bestwatch_hedge_events_total counter",
+    ]
+    lines += [f'bestwatch_hedge_events_total{{event="{event}"}} {count}' for event, count in hedge_stats.items()]
+    lines += [
+        "# HELP bestwatch_circuit_state Circuit breaker state (0 closed, 1 half-open, 2 open).",
+        "# TYPE bestwatch_circuit_state gauge",
+    ]
+    lines += [
+        f'bestwatch_circuit_state{{provider="{name}"}} {CircuitBreaker.STATES.index(breaker.current_state())}'
+        for name, breaker in circuit_breakers.items()
+    ]
+    lines += [
+        "# HELP bestwatch_http_cache_events_total Response cache events.",
+        "# TYPE bestwatch_http_cache_events_total counter",
+    ]
+    lines += [f'bestwatch_http_cache_events_total{{event="{event}"}} {count}' for event, count in http_cache_stats.items()]
+    lines += [
+        "# TYPE bestwatch_http_cache_hit_ratio gauge",
+        f"bestwatch_http_cache_hit_ratio {get_http_cache_hit_ratio():.4f}",
+        "# TYPE bestwatch_summary_tokens_today gauge",
+        f"bestwatch_summary_tokens_today {summary_tokens_used()}",
+        "# TYPE bestwatch_movie_cache_size gauge",
+        f"bestwatch_movie_cache_size {len(movie_cache)}",
+    ]
+    for name, attribute in (('candidate_pool_size', 'pool'), ('prepared_posts', 'prepared'), ('posted_movies', 'posted')):
+        lines.append(f"# TYPE bestwatch_{name} gauge")
+        lines += [
+            f'bestwatch_{name}{{channel="{channel.name}"}} {len(getattr(channel, attribute))}'
+            for channel in channels
+        ]
+    lines += [
+        "# TYPE bestwatch_rate_limit_available gauge",
+    ]
+    lines += [
+        f'bestwatch_rate_limit_available{{provider="{name}"}} {int(limiter.available())}'
+        for name, limiter in rate_limiters.items()
+    ]
+    cpu = process_info.cpu_times()
+    lines += [
+        "# TYPE bestwatch_event_loop_lag_seconds gauge",
+        f"bestwatch_event_loop_lag_seconds {event_loop_lag['last']:.6f}",
+        "# TYPE bestwatch_event_loop_lag_max_seconds gauge",
+        f"bestwatch_event_loop_lag_max_seconds {event_loop_lag['max']:.6f}",
+        "# TYPE process_resident_memory_bytes gauge",
+        f"process_resident_memory_bytes {process_info.memory_info().rss}",
+        "# TYPE process_cpu_seconds_total counter",
+        f"process_cpu_seconds_total {cpu.user + cpu.system:.2f}",
+        "# TYPE process_cpu_percent gauge",
+        f"process_cpu_percent {process_info.cpu_percent(None):.1f}",
+        "# TYPE bestwatch_time_to_first_poll_seconds gauge",
+        f"bestwatch_time_to_first_poll_seconds {startup_stats['ready_seconds'] or 0}",
+        "# TYPE process_uptime_seconds gauge",
+        f"process_uptime_seconds {time.monotonic() - started_at_monotonic:.0f}",
+    ]
+    return "\n".join(lines) + "\n"
+
+def get_health():
+    return {
+        'status': 'ok',
+        'uptime_seconds': round(time.monotonic() - started_at_monotonic),
+        'time_to_first_poll_seconds': startup_stats['ready_seconds'],
+        'refreshing': refresh_task is not None and not refresh_task.done(),
+        'movie_cache': len(movie_cache),
+        'identity_aliases': len(identity_index),
+        'channels': {
+            channel.name: {
+                'candidate_pool': len(channel.pool),
+                'prepared_posts': len(channel.prepared),
+                'posted_movies': len(channel.posted),
+            }
+            for channel in channels
+        },
+        'posts': post_results,
+        'http_cache_hit_ratio': round(get_http_cache_hit_ratio(), 4),
+        'summary_tokens_today': summary_tokens_used(),
+        'rate_limits': get_rate_limit_state(),
+        'circuits': {name: breaker.current_state() for name, breaker in circuit_breakers.items()},
+        'hedge': hedge_stats,
+        'telegram_send': send_stats,
+        'event_loop_lag_ms': round(event_loop_lag['last'] * 1000, 1),
+        'rss_mb': round(process_info.memory_info().rss / 1024 / 1024, 1),
+    }
+
+# ----------------- کلاینت HTTP مشترک -----------------
+# یک ClientSession برای کل برنامه تا اتصال‌ها (TCP/TLS) و کش DNS بین درخواست‌ها استفاده مجدد شوند
+SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+http_session = None
+
+def get_provider(url):
+    if url.startswith(TMDB_API_BASE) or url.startswith(TMDB_IMAGE_BASE):
+        return 'tmdb'
+    if url.startswith(OMDB_API_BASE):
+        return 'omdb'
+    if url.startswith(RAPIDAPI_BASE):
+        return 'rapidapi'
+    if url.startswith(TELEGRAM_API_BASE):
+        return 'telegram'
+    if url.startswith(GEMINI_API_BASE):
+        return 'gemini'
+    return 'default'
+
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+            ssl=SSL_CONTEXT
+        )
+        http_session = aiohttp.ClientSession(connector=connector, timeout=HTTP_TIMEOUTS['default'])
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+# ----------------- محدودیت نرخ درخواست -----------------
+# هر سرویس یک سطل توکن، شمارنده سهمیه روزانه و وضعیت backoff دارد.
+# زمان‌بند (مثلاً fetch_movies_to_cache) با provider_available کار را به جای شکست، به تعویق می‌اندازد.
+class ProviderLimiter:
+    def __init__(self, name, rate, burst, daily_quota=0):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.daily_quota = daily_quota
+        self.quota_day = None
+        self.used_today = 0
+        self.blocked_until = 0.0
+        self.throttle_count = 0
+        self.retry_budget = float(RETRY_BUDGET_MAX)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _roll_quota_day(self):
+        today = datetime.utcnow().strftime('%Y-%m-%d')
+        if self.quota_day is None and self.daily_quota:
+            saved = store_get_meta(f'quota:{self.name}', {})
+            if saved.get('day') == today:
+                self.used_today = saved.get('used', 0)
+            self.quota_day = today
+        if self.quota_day != today:
+            self.quota_day = today
+            self.used_today = 0
+
+    def quota_remaining(self):
+        if not self.daily_quota:
+            return None
+        self._roll_quota_day()
+        return max(0, self.daily_quota - self.used_today)
+
+    def defer_seconds(self):
+        # چند ثانیه تا قابل استفاده شدن دوباره سرویس
+        if self.daily_quota and self.quota_remaining() == 0:
+            now = datetime.utcnow()
+            tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+            return (tomorrow - now).total_seconds()
+        return max(0.0, self.blocked_until - time.monotonic())
+
+    def available(self):
+        return self.defer_seconds() <= RATE_LIMIT_MAX_WAIT
+
+    async def acquire(self):
+        # گرفتن یک توکن؛ اگر انتظار خیلی طولانی باشد False برمی‌گرداند تا کار به تعویق بیفتد
+        while True:
+            wait = self.defer_seconds()
+            if wait > RATE_LIMIT_MAX_WAIT:
+                return False
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                if self.daily_quota:
+                    self.used_today += 1
+                    store_set_meta(f'quota:{self.name}', {'day': self.quota_day, 'used': self.used_today})
+                return True
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def record_success(self):
+        self.throttle_count = 0
+        self.retry_budget = min(RETRY_BUDGET_MAX, self.retry_budget + RETRY_BUDGET_RATIO)
+
+    def record_throttle(self, retry_after=None):
+        # backoff نمایی با jitter، یا مقدار Retry-After اگر سرویس اعلام کرده باشد
+        self.throttle_count += 1
+        if retry_after is not None:
+            delay = retry_after
+        else:
+            delay = min(300.0, 2 ** self.throttle_count) * random.uniform(0.5, 1.5)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        logger.warning(f"محدودیت نرخ {self.name}: توقف به مدت {delay:.1f} ثانیه.")
+        return delay
+
+    def exhaust_quota(self):
+        if self.daily_quota:
+            self._roll_quota_day()
+            self.used_today = self.daily_quota
+            store_set_meta(f'quota:{self.name}', {'day': self.quota_day, 'used': self.used_today})
+            logger.warning(f"سهمیه روزانه {self.name} به پایان رسید.")
+
+    def take_retry(self):
+        if self.retry_budget >= 1:
+            self.retry_budget -= 1
+            return True
+        return False
+
+    def state(self):
+        return {
+            'available': self.available(),
+            'defer_seconds': round(self.defer_seconds(), 1),
+            'tokens': round(self.tokens, 2),
+            'quota_remaining': self.quota_remaining(),
+            'retry_budget': round(self.retry_budget, 1),
+        }
+
+rate_limiters = {
+    name: ProviderLimiter(name, rate, burst, DAILY_QUOTAS.get(name, 0))
+    for name, (rate, burst) in RATE_LIMITS.items()
+}
+
+# ----------------- مدارشکن سرویس‌ها -----------------
+# بعد از CIRCUIT_FAILURE_THRESHOLD خطای پشت سر هم (5xx، timeout، خطای اتصال) مدار باز می‌شود و درخواستی
+# به آن سرویس فرستاده نمی‌شود؛ بعد از CIRCUIT_RESET_TIMEOUT فقط یک درخواست آزمایشی (half-open) اجازه دارد.
+class CircuitBreaker:
+    STATES = ('closed', 'half_open', 'open')
+
+    def __init__(self, name, threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def current_state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def available(self):
+        state = self.current_state()
+        return state == 'closed' or (state == 'half_open' and not self.probing)
+
+    def allow(self):
+        if not self.available():
+            return False
+        if self.current_state() == 'half_open':
+            self.probing = True
+        return True
+
+    def release(self):
+        # درخواست آزمایشی ارسال نشد (مثلاً به دلیل محدودیت نرخ)
+        self.probing = False
+
+    def record(self, ok):
+        if ok:
+            if self.opened_at is not None:
+                logger.info(f"مدار سرویس {self.name} دوباره بسته شد.")
+            self.failures, self.opened_at, self.probing = 0, None, False
+            return
+        self.failures += 1
+        if self.probing or self.failures >= self.threshold:
+            if self.opened_at is None or self.probing:
+                logger.warning(f"مدار سرویس {self.name} پس از {self.failures} خطا برای {self.reset_timeout:.0f} ثانیه باز شد.")
+            self.opened_at, self.probing = time.monotonic(), False
+
+circuit_breakers = {name: CircuitBreaker(name) for name in ('tmdb', 'omdb', 'rapidapi')}
+
+def provider_available(provider):
+    limiter = rate_limiters.get(provider)
+    breaker = circuit_breakers.get(provider)
+    return (limiter.available() if limiter else True) and (breaker.available() if breaker else True)
+
+def get_rate_limit_state():
+    return {name: limiter.state() for name, limiter in rate_limiters.items()}
+
+def parse_retry_after(value):
+    if not value:
         return None
-    except Exception as e:
-        logger.error(f"خطای نامشخص در درخواست به {url}: {e}")
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
         return None
-    finally:
-        if should_close_session:
-            await session.close()
 
-async def post_api_request(url, json_data=None, headers=None, session=None, timeout=30):
-    if session is None:
-        session = aiohttp.ClientSession(timeout=ClientTimeout(total=timeout))
-        should_close_session = True
-    else:
-        should_close_session = False
+def get_retry_delay(attempt):
+    return min(30.0, 2 ** attempt) * random.uniform(0.5, 1.5)
+
+# ----------------- کش پاسخ‌های HTTP -----------------
+# پاسخ‌های GET سرویس‌ها با TTL مخصوص هر endpoint روی دیسک (SQLite) نگه داشته می‌شوند.
+# پس از انقضا، اگر سرویس ETag/Last-Modified داده باشد، درخواست شرطی ارسال می‌شود.
+http_cache_db = None
+http_cache_lock = threading.Lock()
+http_cache_bytes = 0
+http_cache_stats = {'hit': 0, 'miss': 0, 'revalidated': 0, 'stale': 0, 'evicted': 0}
+
+def get_http_cache_ttl(url):
+    parts = urllib.parse.urlsplit(url)
+    provider = get_provider(url)
+    if provider == 'tmdb':
+        if parts.path.endswith('/discover/movie'):
+            return HTTP_CACHE_TTL_DISCOVER
+        if '/search/' in parts.path:
+            return HTTP_CACHE_TTL_SEARCH
+        if re.search(r'/movie/\d+(/credits)?$', parts.path):
+            return HTTP_CACHE_TTL_DETAILS
+        return 0
+    if provider in ('omdb', 'rapidapi'):
+        return HTTP_CACHE_TTL_DETAILS
+    return 0
+
+def get_http_cache_key(url, params=None):
+    if params:
+        url = f"{url}?{urllib.parse.urlencode(sorted((k, str(v)) for k, v in params.items()))}"
+    # هش کردن کلید تا کلیدهای API داخل آدرس روی دیسک ذخیره نشوند
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+def open_http_cache():
+    global http_cache_db, http_cache_bytes
+    if http_cache_db is None:
+        http_cache_db = sqlite3.connect(HTTP_CACHE_FILE, check_same_thread=False)
+        http_cache_db.execute("PRAGMA journal_mode=WAL")
+        http_cache_db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, body BLOB, etag TEXT, last_modified TEXT, "
+            "expires_at REAL, accessed_at REAL, size INTEGER)"
+        )
+        http_cache_db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed_at)")
+        http_cache_bytes = http_cache_db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    return http_cache_db
+
+def http_cache_get(key):
+    with http_cache_lock:
+        db = open_http_cache()
+        row = db.execute(
+            "SELECT body, etag, last_modified, expires_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        db.commit()
+        return {'body': row[0], 'etag': row[1], 'last_modified': row[2], 'expires_at': row[3]}
+
+def http_cache_put(key, body, etag, last_modified, expires_at):
+    global http_cache_bytes
+    with http_cache_lock:
+        db = open_http_cache()
+        old = db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        db.execute(
+            "INSERT OR REPLACE INTO responses (key, body, etag, last_modified, expires_at, accessed_at, size) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, body, etag, last_modified, expires_at, time.time(), len(body))
+        )
+        http_cache_bytes += len(body) - (old[0] if old else 0)
+
+        # حذف قدیمی‌ترین پاسخ‌ها (LRU) تا حجم کش زیر سقف برگردد
+        if http_cache_bytes > HTTP_CACHE_MAX_BYTES:
+            target = HTTP_CACHE_MAX_BYTES * 0.9
+            for old_key, size in db.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+                if http_cache_bytes <= target:
+                    break
+                db.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                http_cache_bytes -= size
+                http_cache_stats['evicted'] += 1
+        db.commit()
+
+def http_cache_touch(key, expires_at):
+    with http_cache_lock:
+        db = open_http_cache()
+        db.execute(
+            "UPDATE responses SET expires_at = ?, accessed_at = ? WHERE key = ?",
+            (expires_at, time.time(), key)
+        )
+        db.commit()
+
+def close_http_cache():
+    global http_cache_db
+    with http_cache_lock:
+        if http_cache_db is not None:
+            http_cache_db.close()
+            http_cache_db = None
+
+def get_http_cache_hit_ratio():
+    hits = http_cache_stats['hit'] + http_cache_stats['revalidated']
+    total = hits + http_cache_stats['miss']
+    return hits / total if total else 0.0
+
+async def make_api_request(url, params=None, headers=None, session=None, timeout=None, cache=True, on_send=None):
+    # on_send درست قبل از ارسال واقعی درخواست (بعد از انتظار محدودیت نرخ) صدا زده می‌شود
+    session = session or get_http_session()
+    if timeout is None:
+        timeout = HTTP_TIMEOUTS[get_provider(url)]
+    elif not isinstance(timeout, ClientTimeout):
+        timeout = ClientTimeout(total=timeout)
+
+    # بررسی کش پاسخ‌ها قبل از ارسال درخواست
+    ttl = get_http_cache_ttl(url) if cache else 0
+    cache_key = cached = None
+    if ttl:
+        cache_key = get_http_cache_key(url, params)
+        try:
+            cached = await asyncio.to_thread(http_cache_get, cache_key)
+        except Exception as e:
+            logger.error(f"خطا در خواندن کش پاسخ‌ها: {e}")
+        if cached and cached['expires_at'] > time.time():
+            http_cache_stats['hit'] += 1
+            return json.loads(cached['body'])
+        if cached:
+            # درخواست شرطی برای پاسخ منقضی شده
+            headers = dict(headers or {})
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
     
+    provider = get_provider(url)
+    limiter = rate_limiters.get(provider)
+    breaker = circuit_breakers.get(provider)
+    for attempt in range(API_MAX_RETRIES + 1):
+        if breaker and not breaker.allow():
+            logger.warning(f"مدار سرویس {provider} باز است؛ درخواست به {url} ارسال نشد.")
+            break
+        try:
+            acquired = not limiter or await limiter.acquire()
+        except asyncio.CancelledError:
+            # لغو در انتظار توکن (مثلاً hedge)؛ درخواست آزمایشی half-open باید آزاد شود
+            if breaker:
+                breaker.release()
+            raise
+        if not acquired:
+            logger.warning(f"درخواست به {provider} به دلیل محدودیت نرخ/سهمیه به تعویق افتاد.")
+            if breaker:
+                breaker.release()
+            break
+
+        retry_delay = None
+        started = time.monotonic()
+        if on_send:
+            on_send()
+        try:
+            async with session.get(url, params=params, headers=headers, timeout=timeout) as response:
+                record_upstream_request(provider, time.monotonic() - started, status=response.status)
+                if breaker:
+                    breaker.record(response.status < 500)
+                if response.status == 304 and cached:
+                    http_cache_stats['revalidated'] += 1
+                    await asyncio.to_thread(http_cache_touch, cache_key, time.time() + ttl)
+                    return json.loads(cached['body'])
+                if response.status == 200:
+                    body = await response.read()
+                    data = json.loads(body)
+                    if limiter:
+                        limiter.record_success()
+                    if provider == 'omdb' and isinstance(data, dict) and 'limit' in str(data.get('Error', '')).lower():
+                        limiter.exhaust_quota()
+                    if ttl:
+                        http_cache_stats['miss'] += 1
+                    # پاسخ‌های ناموفق OMDB (مثل اتمام سهمیه) با کد 200 برمی‌گردند و نباید کش شوند
+                    if ttl and not (isinstance(data, dict) and data.get('Response') == 'False'):
+                        await asyncio.to_thread(
+                            http_cache_put, cache_key, body,
+                            response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                            time.time() + ttl
+                        )
+                    return data
+                if response.status == 429 and limiter:
+                    # acquire بعدی خودش تا پایان backoff صبر می‌کند
+                    limiter.record_throttle(parse_retry_after(response.headers.get('Retry-After')))
+                    retry_delay = 0
+                elif response.status >= 500:
+                    retry_delay = parse_retry_after(response.headers.get('Retry-After')) or get_retry_delay(attempt)
+                logger.error(f"خطا در درخواست API به {url} (کد: {response.status}): {await response.text()}")
+        except aiohttp.client_exceptions.ClientConnectorError as e:
+            record_upstream_request(provider, time.monotonic() - started, error='connection')
+            if breaker:
+                breaker.record(False)
+            logger.error(f"خطای اتصال SSL/DNS در درخواست به {url}: {e}. بررسی فایل certifi.")
+            retry_delay = get_retry_delay(attempt)
+        except asyncio.TimeoutError:
+            record_upstream_request(provider, time.monotonic() - started, error='timeout')
+            if breaker:
+                breaker.record(False)
+            logger.error(f"پایان زمان درخواست به {url}.")
+            retry_delay = get_retry_delay(attempt)
+        except asyncio.CancelledError:
+            # درخواست hedge شده که دیگر لازم نیست؛ خطای سرویس حساب نمی‌شود
+            if breaker:
+                breaker.release()
+            raise
+        except Exception as e:
+            record_upstream_request(provider, time.monotonic() - started, error='other')
+            if breaker:
+                breaker.record(False)
+            logger.error(f"خطای نامشخص در درخواست به {url}: {e}")
+
+        # تلاش مجدد فقط برای خطاهای موقتی و تا وقتی بودجه تلاش مجدد سرویس تمام نشده باشد
+        if retry_delay is None or attempt == API_MAX_RETRIES or (limiter and not limiter.take_retry()):
+            break
+        await asyncio.sleep(retry_delay)
+
+    # در صورت خطا، پاسخ منقضی شده کش بهتر از هیچ است
+    if cached:
+        http_cache_stats['stale'] += 1
+        return json.loads(cached['body'])
+    if ttl:
+        http_cache_stats['miss'] += 1
+    return None
+
+async def post_api_request(url, json_data=None, headers=None, session=None, timeout=None):
+    session = session or get_http_session()
+    if timeout is None:
+        timeout = HTTP_TIMEOUTS[get_provider(url)]
+    elif not isinstance(timeout, ClientTimeout):
+        timeout = ClientTimeout(total=timeout)
+    
+    provider = get_provider(url)
+    started = time.monotonic()
     try:
-        async with session.post(url, json=json_data, headers=headers) as response:
+        async with session.post(url, json=json_data, headers=headers, timeout=timeout) as response:
+            record_upstream_request(provider, time.monotonic() - started, status=response.status)
             if response.status == 200:
-                return await response.json()
+                return await response.json(content_type=None)
             else:
                 logger.error(f"خطا در درخواست POST به {url} (کد: {response.status}): {await response.text()}")
                 return None
+    except asyncio.TimeoutError:
+        record_upstream_request(provider, time.monotonic() - started, error='timeout')
+        logger.error(f"پایان زمان درخواست POST به {url}.")
+        return None
     except Exception as e:
+        record_upstream_request(provider, time.monotonic() - started, error='other')
         logger.error(f"خطای نامشخص در درخواست POST به {url}: {e}")
         return None
-    finally:
-        if should_close_session:
-            await session.close()
 
 
-async def generate_summary(title, year):
-    # ... (توابع generate_summary)
-    if not GEMINI_MODEL:
+# ----------------- خلاصه فیلم‌ها (Gemini) -----------------
+# چند فیلم در یک درخواست با خروجی JSON ساختاریافته خلاصه می‌شوند و نتیجه با کلید عنوان|سال|مدل|نسخه پرامپت
+# در دیتابیس می‌ماند؛ ارسال ناموفق یا آماده‌سازی دوباره هیچ‌وقت خلاصه را دوباره تولید نمی‌کند.
+SUMMARY_PROMPT = (
+    "برای هر فیلم در لیست JSON زیر یک خلاصه کوتاه، جذاب و دقیق (حداکثر ۱۰۰ کلمه) بنویس. فقط خلاصه فیلم را بنویس.\n"
+    "برای هر فیلم یک آیتم با همان id و خلاصه آن در summary برگردان.\n"
+)
+SUMMARY_RESPONSE_SCHEMA = {
+    'type': 'ARRAY',
+    'items': {
+        'type': 'OBJECT',
+        'properties': {'id': {'type': 'INTEGER'}, 'summary': {'type': 'STRING'}},
+        'required': ['id', 'summary'],
+    },
+}
+
+def summary_tokens_used():
+    usage = store_get_meta('summary_tokens', {})
+    return usage.get('used', 0) if usage.get('day') == datetime.utcnow().strftime('%Y-%m-%d') else 0
+
+def record_summary_tokens(count):
+    store_set_meta('summary_tokens', {'day': datetime.utcnow().strftime('%Y-%m-%d'), 'used': summary_tokens_used() + count})
+
+async def request_gemini(payload):
+    limiter = rate_limiters['gemini']
+    if not await limiter.acquire():
+        logger.warning("درخواست Gemini به دلیل محدودیت نرخ به تعویق افتاد.")
         return None
 
-    prompt = f"یک خلاصه کوتاه، جذاب و دقیق (حداکثر ۱۰۰ کلمه) درباره فیلم {title} ({year}) بنویس. فقط خلاصه فیلم را بنویس."
-    
+    url = f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:generateContent"
+    started = time.monotonic()
     try:
-        client = genai.Client()
-        response = await asyncio.to_thread(
-            client.models.generate_content,
-            model=GEMINI_MODEL,
-            contents=prompt
-        )
-        return response.text.strip()
-    except google_exceptions.ResourceExhausted as e:
-        logger.error(f"خطای اتمام منابع Gemini (ResourceExhausted): {e}")
-        await send_admin_alert(None, "❌ خطا: منابع Gemini به اتمام رسیده است.")
-        return "خلاصه فیلم به دلیل اتمام منابع Google Gemini موقتاً در دسترس نیست."
+        async with get_http_session().post(
+            url, json=payload, headers={'x-goog-api-key': GOOGLE_API_KEY}, timeout=HTTP_TIMEOUTS['gemini']
+        ) as response:
+            record_upstream_request('gemini', time.monotonic() - started, status=response.status)
+            if response.status == 200:
+                limiter.record_success()
+                return await response.json(content_type=None)
+            if response.status == 429:
+                logger.error(f"خطای اتمام منابع Gemini (RESOURCE_EXHAUSTED): {await response.text()}")
+                limiter.record_throttle(parse_retry_after(response.headers.get('Retry-After')))
+                await send_admin_alert(None, "❌ خطا: منابع Gemini به اتمام رسیده است.")
+                return None
+            logger.error(f"خطا در درخواست Gemini (کد: {response.status}): {await response.text()}")
+            return None
+    except asyncio.TimeoutError:
+        record_upstream_request('gemini', time.monotonic() - started, error='timeout')
+        logger.error("پایان زمان درخواست Gemini.")
+        return None
     except Exception as e:
+        record_upstream_request('gemini', time.monotonic() - started, error='other')
         logger.error(f"خطای نامشخص در تولید خلاصه Gemini: {e}")
         return None
 
+async def request_summary_batch(movies):
+    # movies: لیست (title, year)؛ خروجی: لیست خلاصه‌ها به همان ترتیب (None برای موارد ناموفق)
+    items = [{'id': i, 'title': title, 'year': year} for i, (title, year) in enumerate(movies)]
+    data = await request_gemini({
+        'contents': [{'role': 'user', 'parts': [{'text': SUMMARY_PROMPT + json.dumps(items, ensure_ascii=False)}]}],
+        'generationConfig': {'responseMimeType': 'application/json', 'responseSchema': SUMMARY_RESPONSE_SCHEMA},
+    })
+    if not data:
+        return [None] * len(movies)
+    record_summary_tokens((data.get('usageMetadata') or {}).get('totalTokenCount', 0))
+    try:
+        text = ''.join(part.get('text', '') for part in data['candidates'][0]['content']['parts'])
+        parsed = {item['id']: item['summary'].strip() for item in json.loads(text) if item.get('summary')}
+    except (KeyError, IndexError, TypeError, ValueError, AttributeError) as e:
+        logger.error(f"پاسخ نامعتبر Gemini برای {len(movies)} فیلم: {e}")
+        return [None] * len(movies)
+    return [parsed.get(i) for i in range(len(movies))]
+
+async def generate_summaries(movies):
+    # خلاصه‌های موجود از کش خوانده و بقیه در دسته‌های SUMMARY_BATCH_SIZE تایی تولید می‌شوند
+    if not GEMINI_MODEL:
+        return [None] * len(movies)
+    keys = [summary_key(title, year) for title, year in movies]
+    missing = list({key: movie for key, movie in zip(keys, movies) if not store_get_summary(key)}.items())
+    for i in range(0, len(missing), SUMMARY_BATCH_SIZE):
+        batch = missing[i:i + SUMMARY_BATCH_SIZE]
+        summaries = await request_summary_batch([movie for _, movie in batch])
+        for (key, _), summary in zip(batch, summaries):
+            if summary:
+                store_set_summary(key, summary)
+        if not any(summaries):
+            break # Gemini در دسترس نیست؛ بقیه دسته‌ها را امتحان نمی‌کنیم
+    return [store_get_summary(key) for key in keys]
+
+async def generate_summary(title, year):
+    return (await generate_summaries([(title, year)]))[0]
+
+async def prewarm_summaries():
+    # پیش‌تولید خلاصه فیلم‌های پروزن مخزن‌ها در پس‌زمینه، تا سقف بودجه توکن روزانه
+    if not GEMINI_MODEL or not SUMMARY_TOKEN_BUDGET:
+        return 0
+    movie_ids = sorted(
+        {movie_id for channel in channels for movie_id in channel.pool.ids if movie_id in movie_cache},
+        key=lambda movie_id: movie_weight(movie_cache[movie_id]), reverse=True
+    )
+    pending = [
+        (movie_cache[movie_id]['title'], movie_cache[movie_id]['year']) for movie_id in movie_ids
+        if not store_get_summary(summary_key(movie_cache[movie_id]['title'], movie_cache[movie_id]['year']))
+    ]
+    generated = 0
+    for i in range(0, len(pending), SUMMARY_BATCH_SIZE):
+        batch = pending[i:i + SUMMARY_BATCH_SIZE]
+        if summary_tokens_used() + len(batch) * SUMMARY_TOKENS_PER_MOVIE > SUMMARY_TOKEN_BUDGET:
+            logger.info("بودجه توکن روزانه پیش‌تولید خلاصه‌ها تمام شد.")
+            break
+        if not provider_available('gemini'):
+            break
+        summaries = await generate_summaries(batch)
+        if not any(summaries):
+            break
+        generated += sum(1 for summary in summaries if summary)
+    logger.info(f"پیش‌تولید خلاصه‌ها: {generated} خلاصه جدید، {len(pending) - generated} در انتظار، {summary_tokens_used()} توکن مصرف شده امروز.")
+    return generated
+
 # ----------------- توابع دریافت فیلم‌ها -----------------
 # ... (توابع get_movie_details_omdb_rapid، get_movie_details_tmdb)
 async def get_movie_details_tmdb(movie_id):
@@ -190,21 +1818,27 @@ async def get_movie_details_tmdb(movie_id):
         return None
 
     # آدرس API: https://api.themoviedb.org/3/movie/
-    url = f"https://api.themoviedb.org/3/movie/{movie_id}"
+    url = f"{TMDB_API_BASE}/movie/{movie_id}"
     headers = {
         "Authorization": f"Bearer {TMDB_API_KEY}",
         "accept": "application/json"
     }
 
-    data = await make_api_request(url, headers=headers)
+    # دریافت همزمان جزئیات و اطلاعات بازیگران (مثل بازیگران)
+    credits_url = f"{TMDB_API_BASE}/movie/{movie_id}/credits"
+    data, credits_data = await asyncio.gather(
+        make_api_request(url, headers=headers),
+        make_api_request(credits_url, headers=headers)
+    )
     if not data:
         return None
 
-    # دریافت جزئیات اضافی (مثل بازیگران)
-    credits_url = f"https://api.themoviedb.org/3/movie/{movie_id}/credits"
-    credits_data = await make_api_request(credits_url, headers=headers)
-    
-    # ... (استخراج بازیگران)
+    # استخراج بازیگران و عوامل
+    credits_data = credits_data or {}
+    cast_list = [c.get('name') for c in credits_data.get('cast', [])[:5]]
+    crew = credits_data.get('crew', [])
+    director_list = [c.get('name') for c in crew if c.get('job') == 'Director']
+    writer_list = [c.get('name') for c in crew if c.get('department') == 'Writing']
     
     # ساخت دیکشنری نهایی
     details = {
@@ -217,6 +1851,7 @@ async def get_movie_details_tmdb(movie_id):
         'runtime': data.get('runtime'),
         'overview': data.get('overview'),
         'genres': [g.get('name') for g in data.get('genres', [])],
+        'original_language': data.get('original_language'),
         'poster_path': data.get('poster_path'),
         'vote_average': data.get('vote_average'),
         'vote_count': data.get('vote_count'),
@@ -229,56 +1864,145 @@ async def get_movie_details_tmdb(movie_id):
     return details
 
 
+async def fetch_omdb_details(imdb_id, on_send=None):
+    # None یعنی درخواست ناموفق بود؛ {} یعنی OMDB این فیلم را ندارد
+    omdb_url = f"{OMDB_API_BASE}/?i={imdb_id}&apikey={OMDB_API_KEY}"
+    omdb_data = await make_api_request(omdb_url, on_send=on_send)
+    if not omdb_data:
+        return None
+    if omdb_data.get('Response') != 'True':
+        return {}
+    return {
+        'rated': omdb_data.get('Rated'),
+        'plot': omdb_data.get('Plot'),
+        'language': omdb_data.get('Language'),
+        'country': omdb_data.get('Country'),
+        'awards': omdb_data.get('Awards'),
+        'metascore': omdb_data.get('Metascore'),
+        'imdb_rating': omdb_data.get('imdbRating'),
+        'imdb_votes': omdb_data.get('imdbVotes'),
+        'box_office': omdb_data.get('BoxOffice'),
+        'production': omdb_data.get('Production'),
+        'website': omdb_data.get('Website'),
+        'director': omdb_data.get('Director'),
+        'writer': omdb_data.get('Writer'),
+        'actors': omdb_data.get('Actors'),
+    }
+
+async def fetch_rapidapi_details(imdb_id):
+    rapidapi_url = f"{RAPIDAPI_BASE}/movie/{imdb_id}"
+    headers = {
+        "X-RapidAPI-Key": RAPIDAPI_KEY,
+        "X-RapidAPI-Host": "movie-details-by-imdb-id.p.rapidapi.com"
+    }
+    rapid_data = await make_api_request(rapidapi_url, headers=headers)
+    if not rapid_data or rapid_data.get('status') != 'OK':
+        return None
+    # امتیاز RapidAPI همان امتیاز IMDb است و اگر زودتر برسد جای imdb_rating را هم پر می‌کند
+    return {'imdb_rating': rapid_data.get('rating'), 'rapid_rating': rapid_data.get('rating')}
+
+background_requests = set() # درخواست‌های OMDB که بعد از hedge رها شده‌اند ولی لغو نمی‌شوند
+
+def apply_late_omdb(imdb_id, task):
+    # تکمیل فیلمی که با داده‌های RapidAPI ذخیره شده و منتظر OMDB مانده بود
+    if task.cancelled() or task.exception() or not task.result():
+        return
+    movie_id = resolve_identity(imdb_id=imdb_id)
+    details = movie_cache.get(movie_id) if movie_id else None
+    if details is None or not details.get('omdb_pending'):
+        return # فیلم هنوز ذخیره نشده؛ پاسخ در کش HTTP است و دریافت بعدی بدون درخواست جدید کاملش می‌کند
+    late = {key: value for key, value in task.result().items() if value not in (None, '', 'N/A')}
+    cache_put_movie(movie_id, {**details, **late, 'omdb_pending': False})
+
+def merge_first_arrival(merged, details):
+    # هر فیلد از اولین پاسخی که مقدار معتبر برایش داشته باشد گرفته می‌شود
+    for key, value in (details or {}).items():
+        if key not in merged and value not in (None, '', 'N/A'):
+            merged[key] = value
+
 async def get_movie_details_omdb_rapid(imdb_id):
-    # ...
-    # API call to OMDB and RapidAPI
+    # OMDB منبع اصلی است؛ اگر تا صدک ۹۵ تأخیرش جواب نداد (یا مدارش باز است) RapidAPI هم همزمان صدا زده می‌شود.
+    # اگر RapidAPI جواب داد و OMDB باز هم دیر کرد، با همان داده‌ها ادامه می‌دهیم و تکمیل OMDB به دریافت بعدی موکول می‌شود.
+    # زمان hedge از ارسال واقعی درخواست OMDB حساب می‌شود (مثل نمونه‌های صدک)، نه از انتظار برای توکن محدودیت نرخ.
     if not OMDB_API_KEY and not RAPIDAPI_KEY:
         logger.error("OMDB_API_KEY و RAPIDAPI_KEY تنظیم نشده‌اند.")
         return None
 
-    details = {}
-    
-    # مرحله ۱: تماس با OMDB API
-    if OMDB_API_KEY:
-        omdb_url = f"http://www.omdbapi.com/?i={imdb_id}&apikey={OMDB_API_KEY}"
-        omdb_data = await make_api_request(omdb_url)
-        
-        if omdb_data and omdb_data.get('Response') == 'True':
-            details.update({
-                'rated': omdb_data.get('Rated'),
-                'plot': omdb_data.get('Plot'),
-                'language': omdb_data.get('Language'),
-                'country': omdb_data.get('Country'),
-                'awards': omdb_data.get('Awards'),
-                'metascore': omdb_data.get('Metascore'),
-                'imdb_rating': omdb_data.get('imdbRating'),
-                'imdb_votes': omdb_data.get('imdbVotes'),
-                'box_office': omdb_data.get('BoxOffice'),
-                'production': omdb_data.get('Production'),
-                'website': omdb_data.get('Website'),
-                'director': omdb_data.get('Director'),
-                'writer': omdb_data.get('Writer'),
-                'actors': omdb_data.get('Actors'),
-            })
-
-    # مرحله ۲: تماس با RapidAPI (اگر OMDB اطلاعات کافی نداد یا اگر نیاز به امتیازهای دیگر داریم)
-    # این بخش باید بر اساس نیاز پروژه شما و اینکه RapidAPI شما چیست، سفارشی شود.
-    # به دلیل عدم اطلاع از سرویس دقیق RapidAPI، این بخش را فقط برای مثال نگه می‌داریم:
-    if RAPIDAPI_KEY and not details.get('imdb_rating'):
-        rapidapi_url = f"https://movie-details-by-imdb-id.p.rapidapi.com/movie/{imdb_id}"
-        headers = {
-            "X-RapidAPI-Key": RAPIDAPI_KEY,
-            "X-RapidAPI-Host": "movie-details-by-imdb-id.p.rapidapi.com"
-        }
-        rapid_data = await make_api_request(rapidapi_url, headers=headers)
-        
-        if rapid_data and rapid_data.get('status') == 'OK':
-            # مثال: اضافه کردن داده‌های RapidAPI
-            details['rapid_rating'] = rapid_data.get('rating')
-            # ...
-            pass # شما باید اینجا منطق ادغام داده‌ها را بنویسید
+    started = time.monotonic()
+    omdb_sent_at = None
 
-    return details
+    def mark_omdb_sent():
+        nonlocal omdb_sent_at
+        if omdb_sent_at is None:
+            omdb_sent_at = time.monotonic()
+
+    hedge_delay = get_latency_quantile('omdb', HEDGE_QUANTILE, HEDGE_DEFAULT_DELAY)
+    tasks = {}
+    if OMDB_API_KEY and provider_available('omdb'):
+        tasks[asyncio.create_task(fetch_omdb_details(imdb_id, on_send=mark_omdb_sent))] = 'omdb'
+    use_secondary = bool(RAPIDAPI_KEY) and provider_available('rapidapi')
+    pending = set(tasks)
+    merged = {}
+    omdb_result = None
+    deadline = None
+    try:
+        while True:
+            primary_running = any(tasks[task] == 'omdb' for task in pending)
+            elapsed = time.monotonic() - omdb_sent_at if omdb_sent_at is not None else 0.0
+            if use_secondary and not merged.get('imdb_rating') and (not primary_running or elapsed >= hedge_delay):
+                use_secondary = False
+                if primary_running:
+                    hedge_stats['fired'] += 1
+                task = asyncio.create_task(fetch_rapidapi_details(imdb_id))
+                tasks[task] = 'rapidapi'
+                pending.add(task)
+            if not pending:
+                break
+
+            if use_secondary and omdb_sent_at is None:
+                timeout = min(hedge_delay, 0.1) # OMDB هنوز منتظر توکن است؛ زمان hedge شروع نشده
+            elif use_secondary:
+                timeout = max(0.0, hedge_delay - elapsed)
+            elif deadline is not None:
+                timeout = max(0.0, deadline - time.monotonic())
+            else:
+                timeout = None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                try:
+                    result = task.result()
+                except Exception as e:
+                    logger.error(f"خطا در دریافت اطلاعات {tasks[task]} برای {imdb_id}: {e}")
+                    result = None
+                merge_first_arrival(merged, result)
+                if tasks[task] == 'omdb':
+                    omdb_result = result
+                elif result and any(tasks[other] == 'omdb' for other in pending):
+                    hedge_stats['secondary_first'] += 1
+                    deadline = omdb_sent_at + HEDGE_GRACE_FACTOR * hedge_delay
+
+            primary_running = any(tasks[task] == 'omdb' for task in pending)
+            if not primary_running and merged.get('imdb_rating'):
+                break
+            if primary_running and deadline is not None and time.monotonic() >= deadline:
+                hedge_stats['primary_deferred'] += 1
+                break
+    finally:
+        for task in pending:
+            if tasks[task] == 'omdb' and omdb_sent_at is not None:
+                # سهمیه OMDB مصرف شده؛ لغو نمی‌شود و پاسخ دیرتر به فیلم ذخیره شده اضافه می‌شود
+                background_requests.add(task)
+                task.add_done_callback(background_requests.discard)
+                task.add_done_callback(functools.partial(apply_late_omdb, imdb_id))
+            else:
+                task.cancel()
+
+    if OMDB_API_KEY and omdb_result is None:
+        # OMDB جواب نداد (خطا، مدار باز، سهمیه یا دیرکرد)؛ فیلدهای باقی‌مانده بعداً تکمیل می‌شوند
+        merged['omdb_pending'] = True
+    enrichment_latency.observe('omdb_rapid', time.monotonic() - started)
+    return merged
 
 async def get_movie_id_from_tmdb(title, year):
     # ... (توابع get_movie_id_from_tmdb)
@@ -287,17 +2011,23 @@ async def get_movie_id_from_tmdb(title, year):
         logger.error("TMDB_API_KEY تنظیم نشده است.")
         return None
 
+    # فیلم‌های شناخته شده بدون درخواست جستجو پیدا می‌شوند
+    movie_id = resolve_identity(title=title, year=year)
+    if movie_id and movie_id.isdigit():
+        return int(movie_id)
+
     # آدرس API: https://api.themoviedb.org/3/search/movie
-    url = "https://api.themoviedb.org/3/search/movie"
+    url = f"{TMDB_API_BASE}/search/movie"
     headers = {
         "Authorization": f"Bearer {TMDB_API_KEY}",
         "accept": "application/json"
     }
     params = {
         "query": title,
-        "primary_release_year": year,
         "language": "en-US"
     }
+    if year:
+        params["primary_release_year"] = year
 
     data = await make_api_request(url, params=params, headers=headers)
     if data and data.get('results'):
@@ -305,6 +2035,163 @@ async def get_movie_id_from_tmdb(title, year):
         return data['results'][0].get('id')
     return None
 
+async def get_movie_id_from_imdb(imdb_id):
+    # پیدا کردن شناسه TMDB از روی imdb_id با endpoint /find
+    if not TMDB_API_KEY:
+        logger.error("TMDB_API_KEY تنظیم نشده است.")
+        return None
+
+    url = f"{TMDB_API_BASE}/find/{imdb_id}"
+    headers = {
+        "Authorization": f"Bearer {TMDB_API_KEY}",
+        "accept": "application/json"
+    }
+    data = await make_api_request(url, params={"external_source": "imdb_id"}, headers=headers)
+    if data and data.get('movie_results'):
+        return data['movie_results'][0].get('id')
+    return None
+
+# ----------------- خزنده دیسکاور -----------------
+# چند کوئری دیسکاور (مرتب‌سازی، ژانر، دهه) به نوبت و صفحه به صفحه پیمایش می‌شوند.
+# موقعیت هر کوئری در دیتابیس ذخیره می‌شود و فقط وقتی تعداد فیلم‌های آماده کم شود صفحات عمیق‌تر دریافت می‌شوند.
+DISCOVER_BASE_PARAMS = {
+    "include_adult": "false",
+    "include_video": "false",
+    "language": "en-US",
+}
+DISCOVER_QUERIES = {
+    # فیلم‌های برتر ۱۰ سال گذشته (رفتار قبلی)
+    'top_recent': {"sort_by": "vote_average.desc", "vote_count.gte": 1000, "recent_years": 10},
+    'popular': {"sort_by": "popularity.desc", "vote_count.gte": 500},
+    'most_voted': {"sort_by": "vote_count.desc"},
+    'top_2000s': {"sort_by": "vote_average.desc", "vote_count.gte": 1000,
+                  "primary_release_date.gte": "2000-01-01", "primary_release_date.lte": "2009-12-31"},
+    'top_1990s': {"sort_by": "vote_average.desc", "vote_count.gte": 1000,
+                  "primary_release_date.gte": "1990-01-01", "primary_release_date.lte": "1999-12-31"},
+    'top_classics': {"sort_by": "vote_average.desc", "vote_count.gte": 1000,
+                     "primary_release_date.lte": "1989-12-31"},
+    'top_animation': {"sort_by": "vote_average.desc", "vote_count.gte": 500, "with_genres": "16"},
+    'top_thriller': {"sort_by": "vote_average.desc", "vote_count.gte": 500, "with_genres": "53"},
+    'top_comedy': {"sort_by": "vote_average.desc", "vote_count.gte": 500, "with_genres": "35"},
+}
+
+def build_discover_params(query):
+    params = {**DISCOVER_BASE_PARAMS, **query}
+    recent_years = params.pop('recent_years', None)
+    if recent_years:
+        params["primary_release_date.gte"] = (datetime.now() - timedelta(days=365 * recent_years)).strftime('%Y-%m-%d')
+    return params
+
+async def fetch_discover_page(url, params, headers, page):
+    # دریافت یک صفحه از دیسکاور (صفحات به صورت همزمان درخواست می‌شوند)
+    page_params = {**params, "page": page}
+    data = await make_api_request(url, params=page_params, headers=headers)
+    if not data or not data.get('results'):
+        logger.warning(f"دریافت صفحه {page} ناموفق بود.")
+        return [], None
+    return data['results'], data.get('total_pages')
+
+async def crawl_discover(url, headers, needed):
+    cursor = store_get_meta('discover_cursor', {})
+    names = list(DISCOVER_QUERIES)
+    next_index = cursor.get('_next', 0) % len(names)
+    new_movie_ids = []
+    pages_fetched = 0
+
+    for offset in range(len(names)):
+        name = names[(next_index + offset) % len(names)]
+        position = cursor.get(name, {'page': 0, 'total_pages': None})
+        params = build_discover_params(DISCOVER_QUERIES[name])
+
+        while pages_fetched < DISCOVER_PAGES and len(new_movie_ids) < needed:
+            total_pages = min(position['total_pages'] or 500, 500) # TMDB بیشتر از ۵۰۰ صفحه برنمی‌گرداند
+            if position['page'] >= total_pages:
+                break
+
+            # دریافت همزمان صفحات بعدی این کوئری (تا وقتی تعداد صفحات معلوم نیست فقط یک صفحه)
+            first_page = position['page'] + 1
+            page_count = 1
+            if position['total_pages']:
+                page_count = min(DISCOVER_PAGES - pages_fetched, math.ceil((needed - len(new_movie_ids)) / 20))
+            last_page = min(total_pages, first_page + page_count - 1)
+            pages = await asyncio.gather(*(
+                fetch_discover_page(url, params, headers, page)
+                for page in range(first_page, last_page + 1)
+            ))
+            pages_fetched += last_page - first_page + 1
+
+            failed = False
+            for page, (results, page_total) in zip(range(first_page, last_page + 1), pages):
+                if not results:
+                    failed = True # صفحه ناموفق؛ دفعه بعد از همین صفحه ادامه می‌دهیم
+                    break
+                position = {'page': page, 'total_pages': page_total or position['total_pages']}
+                for movie in results:
+                    tmdb_id = movie.get('id')
+                    # فیلم‌های شناخته شده قبل از هر درخواست جزئیات کنار گذاشته می‌شوند
+                    if tmdb_id and not is_known_movie(tmdb_id) and tmdb_id not in new_movie_ids:
+                        new_movie_ids.append(tmdb_id)
+            cursor[name] = position
+            if failed:
+                break
+
+        if pages_fetched >= DISCOVER_PAGES or len(new_movie_ids) >= needed:
+            cursor['_next'] = (next_index + offset + 1) % len(names)
+            break
+
+    if all(cursor.get(name, {}).get('page', 0) >= min(cursor.get(name, {}).get('total_pages') or 500, 500) for name in names):
+        # همه کوئری‌ها تا انتها پیمایش شده‌اند؛ دفعه بعد از ابتدا شروع می‌کنیم (صفحات از کش پاسخ‌ها خوانده می‌شوند)
+        logger.info("پیمایش همه کوئری‌های دیسکاور کامل شد. شروع دوباره از صفحه اول.")
+        cursor = {}
+    store_set_meta('discover_cursor', cursor)
+    logger.info(f"خزنده دیسکاور: {pages_fetched} صفحه، {len(new_movie_ids)} فیلم جدید.")
+    return new_movie_ids
+
+DUPLICATE_MOVIE = object() # خروجی enrich_movie وقتی فیلم با شناسه دیگری قبلاً دیده یا پست شده است
+
+async def enrich_movie(tmdb_id, tmdb_semaphore, omdb_semaphore):
+    # مرحله اول: جزئیات و بازیگران از TMDB (با محدودیت همزمانی جداگانه)
+    async with tmdb_semaphore:
+        started = time.monotonic()
+        details = await get_movie_details_tmdb(tmdb_id)
+        enrichment_latency.observe('tmdb', time.monotonic() - started)
+    if not details:
+        return None
+    if not details.get('imdb_id'):
+        reject_movie(tmdb_id, 'no_imdb_id')
+        return None
+    # همان فیلم قبلاً با شناسه دیگری دیده شده است (imdb_id قدیمی تاریخچه پست یا رکورد تکراری TMDB)
+    known_id = resolve_identity(imdb_id=details['imdb_id'])
+    if known_id and known_id != str(tmdb_id):
+        if not known_id.isdigit():
+            relink_posted(known_id, str(tmdb_id))
+        elif is_known_movie(known_id):
+            logger.info(f"فیلم {tmdb_id} تکراری است (همان {known_id}).")
+            return DUPLICATE_MOVIE
+    if is_posted_anywhere(str(tmdb_id)):
+        return DUPLICATE_MOVIE
+
+    # مرحله دوم: تکمیل اطلاعات از OMDB/RapidAPI
+    # اگر سهمیه OMDB تمام شده باشد، فیلم بدون این اطلاعات ذخیره و تکمیل آن به دریافت بعدی موکول می‌شود
+    if not provider_available('omdb') and not provider_available('rapidapi'):
+        return {**details, 'omdb_pending': True}
+    async with omdb_semaphore:
+        omdb_rapid_details = await get_movie_details_omdb_rapid(details['imdb_id'])
+
+    # ادغام داده‌ها (omdb_pending از نتیجه OMDB/RapidAPI می‌آید)
+    return {**details, 'omdb_pending': omdb_rapid_details is None, **(omdb_rapid_details or {})}
+
+async def complete_pending_movie(movie_id, omdb_semaphore):
+    details = movie_cache.get(movie_id)
+    if not details or not details.get('imdb_id'):
+        return None
+    async with omdb_semaphore:
+        omdb_rapid_details = await get_movie_details_omdb_rapid(details['imdb_id'])
+    if omdb_rapid_details is None or omdb_rapid_details.get('omdb_pending'):
+        return None
+    return {**details, 'omdb_pending': False, **omdb_rapid_details}
+
+@track_job('fetch_movies')
 async def fetch_movies_to_cache():
     # ... (توابع fetch_movies_to_cache)
     # API call to fetch a list of top movies (e.g., TMDB top rated or popular)
@@ -312,59 +2199,232 @@ async def fetch_movies_to_cache():
         logger.error("TMDB_API_KEY تنظیم نشده است.")
         return False
         
-    url = "https://api.themoviedb.org/3/discover/movie"
+    url = f"{TMDB_API_BASE}/discover/movie"
     headers = {
         "Authorization": f"Bearer {TMDB_API_KEY}",
         "accept": "application/json"
     }
-    
-    # پارامترهای دیسکاور (می‌توانید اینجا فیلترهای دلخواه خود را اعمال کنید)
-    params = {
-        "include_adult": "false",
-        "include_video": "false",
-        "language": "en-US",
-        "sort_by": "vote_average.desc",
-        "vote_count.gte": 1000, # حداقل تعداد رای
-        "page": 1,
-        # فیلتر برای فیلم‌های اخیر (مثلاً ۱۰ سال گذشته)
-        "primary_release_date.gte": (datetime.now() - timedelta(days=365*10)).strftime('%Y-%m-%d')
-    }
-    
-    global movie_cache
-    new_movie_ids = set()
-    total_pages = 5 # تعداد صفحاتی که می‌خواهید بررسی کنید
-    
-    async with aiohttp.ClientSession(timeout=ClientTimeout(total=60)) as session:
-        for page in range(1, total_pages + 1):
-            params['page'] = page
-            data = await make_api_request(url, params=params, headers=headers, session=session)
-            
-            if data and data.get('results'):
-                for movie in data['results']:
-                    tmdb_id = movie.get('id')
-                    imdb_id = movie.get('imdb_id') # TMDB در دیسکاور imdb_id را نمی‌دهد، باید جداگانه دریافت شود
-                    
-                    if tmdb_id not in movie_cache and tmdb_id not in posted_movies:
-                        new_movie_ids.add(tmdb_id)
-            else:
-                logger.warning(f"دریافت صفحه {page} ناموفق بود.")
-                break # اگر یک صفحه ناموفق بود، صفحات بعدی را چک نکنید
-
-        # در اینجا باید جزئیات کامل و imdb_id را برای هر فیلم جدید دریافت کنید
-        for tmdb_id in new_movie_ids:
-            if tmdb_id not in movie_cache:
-                details = await get_movie_details_tmdb(tmdb_id)
-                if details and details.get('imdb_id'):
-                    omdb_rapid_details = await get_movie_details_omdb_rapid(details['imdb_id'])
-                    
-                    # ادغام داده‌ها
-                    final_details = {**details, **omdb_rapid_details} 
-                    movie_cache[tmdb_id] = final_details
-                    logger.info(f"فیلم جدید به کش اضافه شد: {details['title']}")
-    
-    await save_cache_to_file()
+
+    if not provider_available('tmdb'):
+        logger.warning(f"دریافت فیلم‌ها به دلیل محدودیت TMDB به تعویق افتاد ({rate_limiters['tmdb'].defer_seconds():.0f} ثانیه).")
+        return len(movie_cache) > 0
+
+    started_at = time.monotonic()
+
+    # مرحله ۱: پیمایش دیسکاور فقط به اندازه کمبود فیلم‌های آماده
+    needed = max((POOL_TARGET - len(channel.pool) for channel in channels), default=0)
+    new_movie_ids = await crawl_discover(url, headers, needed) if needed > 0 else []
+
+    # مرحله ۲ و ۳: تکمیل اطلاعات با محدودیت همزمانی هر مرحله و ذخیره نتایج به محض آماده شدن
+    tmdb_semaphore = asyncio.Semaphore(TMDB_CONCURRENCY)
+    omdb_semaphore = asyncio.Semaphore(OMDB_CONCURRENCY)
+    tasks = [asyncio.create_task(enrich_movie(tmdb_id, tmdb_semaphore, omdb_semaphore)) for tmdb_id in new_movie_ids]
+    # فیلم‌هایی که در دفعات قبل به دلیل سهمیه OMDB ناقص مانده‌اند
+    if provider_available('omdb') or provider_available('rapidapi'):
+        tasks += [
+            asyncio.create_task(complete_pending_movie(movie_id, omdb_semaphore))
+            for movie_id, details in list(movie_cache.items()) if details.get('omdb_pending')
+        ]
+
+    added = 0
+    try:
+        for task in asyncio.as_completed(tasks):
+            try:
+                final_details = await task
+            except Exception as e:
+                logger.error(f"خطا در تکمیل اطلاعات فیلم: {e}")
+                continue
+            if final_details and final_details is not DUPLICATE_MOVIE:
+                is_new = str(final_details['id']) not in movie_cache
+                cache_put_movie(final_details['id'], final_details)
+                if is_new:
+                    added += 1
+                    logger.info(f"فیلم جدید به کش اضافه شد: {final_details['title']}")
+    finally:
+        # با لغو دریافت (مثلاً هنگام خاموش شدن) تسک‌های فرزند هم لغو و منتظر می‌مانیم تا نشست HTTP را رها کنند
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    elapsed = time.monotonic() - started_at
+    throughput = len(new_movie_ids) / elapsed if elapsed > 0 else 0.0
+    logger.info(
+        f"دریافت فیلم‌ها تمام شد: {added} فیلم جدید از {len(new_movie_ids)} عنوان در {elapsed:.1f} ثانیه "
+        f"({throughput:.2f} عنوان در ثانیه)"
+    )
+    logger.info(f"آمار کش پاسخ‌ها: {http_cache_stats} (نرخ برخورد {get_http_cache_hit_ratio():.0%})")
+    logger.info(f"وضعیت محدودیت نرخ سرویس‌ها: {get_rate_limit_state()}")
     return len(movie_cache) > 0
 
+# ----------------- دریافت فیلم‌ها در پس‌زمینه -----------------
+# بات با کش ذخیره شده بلافاصله شروع به کار می‌کند و دریافت فیلم‌ها یک task پس‌زمینه با ردیابی است؛
+# هیچ‌وقت دو دریافت همزمان اجرا نمی‌شود و کسی که به کش پر نیاز دارد منتظر همان task می‌ماند.
+refresh_task = None
+
+async def refresh_movies():
+    try:
+        if not await fetch_movies_to_cache():
+            logger.error("خطا در دریافت لیست فیلم‌ها. ربات ممکن است با لیست خالی کار کند.")
+            return False
+        await refill_post_queue()
+        return True
+    except Exception as e:
+        logger.error(f"خطای نامشخص در دریافت فیلم‌ها در پس‌زمینه: {e}")
+        return False
+
+def start_background_refresh():
+    global refresh_task
+    if refresh_task is None or refresh_task.done():
+        refresh_task = asyncio.create_task(refresh_movies())
+    else:
+        logger.info("دریافت فیلم‌ها از قبل در حال اجراست.")
+    return refresh_task
+
+async def fetch_movies_job(context: ContextTypes.DEFAULT_TYPE):
+    start_background_refresh()
+
+# ----------------- صف ارسال تلگرام -----------------
+# همه پیام‌های خروجی (پست کانال‌ها، هشدارها و پیام‌های ادمین) از این صف می‌گذرند: سقف نرخ کل بات و فاصله
+# پیام‌های هر چت رعایت می‌شود، RetryAfter تلگرام همه ارسال‌ها را تا زمان اعلام شده متوقف می‌کند و خطاهای
+# شبکه‌ای که قطعاً قبل از ارسال درخواست رخ داده‌اند (اتصال برقرار نشد یا اتصال آزاد نبود) دوباره امتحان می‌شوند.
+# بقیه خطاهای شبکه (TimedOut، 5xx، قطع اتصال بعد از ارسال) ممکن است به تلگرام رسیده باشند و تکرار نمی‌شوند.
+class UncertainDelivery(Exception):
+    pass
+
+def is_unsent_error(error):
+    return isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+class SendQueue:
+    def __init__(self, rate, chat_interval, attempts):
+        self.bot = None # در run_bot تنظیم می‌شود
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.attempts = attempts
+        self.tokens = float(rate)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.chat_locks = {}
+        self.chat_next = {}
+        self.inflight = {}
+
+    async def _wait_turn(self, chat_id):
+        while True:
+            now = time.monotonic()
+            wait = max(self.blocked_until, self.chat_next.get(chat_id, 0.0)) - now
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.chat_next[chat_id] = now + self.chat_interval
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def _send(self, method, chat_id, bot, **kwargs):
+        bot = bot or self.bot
+        if bot is None:
+            raise RuntimeError("بات برای ارسال پیام تنظیم نشده است.")
+        # پیام‌های هر چت به ترتیب ارسال می‌شوند
+        lock = self.chat_locks.setdefault(str(chat_id), asyncio.Lock())
+        async with lock:
+            for attempt in range(1, self.attempts + 1):
+                await self._wait_turn(str(chat_id))
+                try:
+                    result = await getattr(bot, method)(chat_id=chat_id, **kwargs)
+                    send_stats['sent'] += 1
+                    return result
+                except telegram.error.RetryAfter as e:
+                    retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                    send_stats['throttled'] += 1
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+                    logger.warning(f"محدودیت ارسال تلگرام: توقف همه ارسال‌ها به مدت {retry_after:.0f} ثانیه.")
+                    if attempt == self.attempts:
+                        raise
+                except telegram.error.BadRequest:
+                    send_stats['failed'] += 1
+                    raise
+                except telegram.error.NetworkError as e:
+                    if not is_unsent_error(e):
+                        # درخواست ممکن است به تلگرام رسیده باشد؛ تکرار آن می‌تواند پست تکراری بسازد
+                        send_stats['uncertain'] += 1
+                        raise UncertainDelivery(str(e)) from e
+                    if attempt == self.attempts:
+                        send_stats['failed'] += 1
+                        raise
+                    delay = min(60.0, 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+                    send_stats['retried'] += 1
+                    logger.warning(f"خطای شبکه در ارسال به {chat_id} ({e}). تلاش دوباره بعد از {delay:.1f} ثانیه.")
+                    await asyncio.sleep(delay)
+                except Exception:
+                    send_stats['failed'] += 1
+                    raise
+
+    async def send(self, method, chat_id, bot=None, key=None, **kwargs):
+        # با key (مثلاً پست یک فیلم در یک کانال) درخواست تکراری تا پایان ارسال قبلی منتظر همان نتیجه می‌ماند
+        if key is None:
+            return await self._send(method, chat_id, bot, **kwargs)
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._send(method, chat_id, bot, **kwargs))
+            self.inflight[key] = task
+
+            def finished(done):
+                self.inflight.pop(key, None)
+                # اگر همه منتظرها لغو شده باشند کسی نتیجه را نمی‌خواند؛ خواندن خطا از هشدار
+                # "Task exception was never retrieved" جلوگیری می‌کند
+                if not done.cancelled():
+                    done.exception()
+
+            task.add_done_callback(finished)
+        return await asyncio.shield(task)
+
+class AlertDigest:
+    # هر هشدار متفاوت فوراً ارسال می‌شود (حداکثر ALERT_BURST در هر بازه)؛ تکرارها و هشدارهای اضافه شمرده
+    # و در پایان بازه در یک پیام خلاصه فرستاده می‌شوند تا قطعی یک سرویس چت ادمین را پر نکند.
+    def __init__(self, interval, burst):
+        self.interval = interval
+        self.burst = burst
+        self.window_started = 0.0
+        self.sent_in_window = 0
+        self.last_sent = {}
+        self.pending = {}
+        self.flush_task = None
+
+    def admit(self, message):
+        now = time.monotonic()
+        if now - self.window_started >= self.interval:
+            self.window_started = now
+            self.sent_in_window = 0
+            self.last_sent = {text: sent_at for text, sent_at in self.last_sent.items() if now - sent_at < self.interval}
+        if message in self.last_sent or self.sent_in_window >= self.burst:
+            self.pending[message] = self.pending.get(message, 0) + 1
+            send_stats['alerts_coalesced'] += 1
+            if self.flush_task is None or self.flush_task.done():
+                self.flush_task = asyncio.create_task(self._flush_later())
+            return False
+        self.last_sent[message] = now
+        self.sent_in_window += 1
+        return True
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        pending, self.pending = self.pending, {}
+        if not pending or not ADMIN_ID:
+            return
+        lines = [f"{count}× {message}" for message, count in sorted(pending.items(), key=lambda item: -item[1])]
+        text = f"📋 خلاصه هشدارهای {self.interval / 60:.0f} دقیقه اخیر:\n" + "\n".join(lines)
+        if len(text) > 4096:
+            text = text[:4095] + "…"
+        try:
+            await telegram_sender.send('send_message', ADMIN_ID, text=text)
+        except Exception as e:
+            logger.error(f"خطا در ارسال خلاصه هشدارها: {e}")
+
+telegram_sender = SendQueue(TELEGRAM_SEND_RATE, TELEGRAM_CHAT_INTERVAL, TELEGRAM_SEND_ATTEMPTS)
+alert_digest = AlertDigest(ALERT_DIGEST_INTERVAL, ALERT_BURST)
+
 # ----------------- توابع تلگرام -----------------
 # ... (توابع build_movie_caption، start، post_movie_job، run_bot)
 def build_movie_caption(details, summary):
@@ -401,143 +2461,710 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("شما ادمین نیستید.")
 
-async def post_movie_job(context: ContextTypes.DEFAULT_TYPE):
-    # ... (توابع post_movie_job)
-    bot = context.bot
-    
-    if not movie_cache:
-        logger.warning("کش فیلم‌ها خالی است. تلاش برای دریافت مجدد...")
-        if not await fetch_movies_to_cache():
-            await send_admin_alert(bot, "⚠️ کش فیلم‌ها خالی است و دریافت مجدد ناموفق بود.")
-            return
+def telegram_length(text):
+    # تلگرام طول متن را با واحد UTF-16 می‌شمارد؛ ایموجی‌هایی مثل 🎬 دو واحد حساب می‌شوند
+    return len(text.encode('utf-16-le')) // 2
 
-    # انتخاب تصادفی
-    available_movies = [id for id in movie_cache.keys() if id not in posted_movies]
-    
-    if not available_movies:
-        logger.warning("تمام فیلم‌های موجود پست شده‌اند. کش را ریست می‌کنیم.")
-        await send_admin_alert(bot, "🔄 تمام فیلم‌های موجود در کش پست شدند. ریست کردن کش فیلم‌های پست شده.")
-        posted_movies.clear()
-        available_movies = list(movie_cache.keys())
-        await save_posted_movies_to_file()
-        
-        if not available_movies:
-            logger.error("کش کاملاً خالی است حتی پس از ریست.")
-            await send_admin_alert(bot, "❌ کش فیلم‌ها کاملاً خالی است.")
-            return
+def fit_movie_caption(details, summary):
+    # کوتاه کردن خلاصه تا کپشن در محدودیت تلگرام جا شود
+    limit = TELEGRAM_CAPTION_LIMIT - TELEGRAM_CAPTION_MARGIN
+    caption, reply_markup = build_movie_caption(details, summary)
+    while summary and telegram_length(caption) > limit:
+        overflow = telegram_length(caption) - limit
+        words = summary[:max(0, len(summary) - overflow - 1)].rsplit(' ', 1)[0]
+        summary = f"{words}…" if words else None
+        caption, reply_markup = build_movie_caption(details, summary)
+    if telegram_length(caption) > limit:
+        # errors='ignore' نیمه یک جفت surrogate بریده شده را حذف می‌کند
+        caption = caption.encode('utf-16-le')[:2 * (limit - 1)].decode('utf-16-le', errors='ignore') + "…"
+    return caption, reply_markup, summary
 
-    chosen_id = random.choice(available_movies)
-    details = movie_cache.get(chosen_id)
-    
+# ----------------- پوستر فیلم‌ها -----------------
+# به جای نسخه original (چند مگابایتی)، اندازه‌ای از TMDB انتخاب می‌شود که در محدودیت تلگرام جا شود.
+# بعد از اولین ارسال، file_id تلگرام ذخیره می‌شود و ارسال‌های بعدی بدون آپلود مجدد انجام می‌شوند.
+async def check_poster_url(url):
+    # True: قابل استفاده، False: قطعاً نامعتبر (404، غیر تصویر، حجم زیاد)، None: خطای موقت (timeout، 429، 5xx)
+    try:
+        async with get_http_session().head(url, timeout=HTTP_TIMEOUTS['tmdb'], allow_redirects=True) as response:
+            if response.status in (404, 410):
+                return False
+            if response.status != 200:
+                logger.warning(f"خطای موقت در بررسی پوستر {url} (کد: {response.status}).")
+                return None
+            if not response.headers.get('Content-Type', '').startswith('image/'):
+                return False
+            size = int(response.headers.get('Content-Length') or 0)
+            return size <= TELEGRAM_PHOTO_LIMIT
+    except Exception as e:
+        logger.error(f"خطا در بررسی پوستر {url}: {e}")
+        return None
+
+def write_file_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def trim_poster_cache():
+    files = sorted(
+        (os.path.join(POSTER_CACHE_DIR, name) for name in os.listdir(POSTER_CACHE_DIR)),
+        key=os.path.getmtime
+    )
+    for path in files[:max(0, len(files) - POSTER_CACHE_MAX_FILES)]:
+        os.remove(path)
+
+async def download_poster(movie_id, url):
+    path = os.path.join(POSTER_CACHE_DIR, f"{movie_id}.jpg")
+    if os.path.exists(path):
+        return path
+    try:
+        async with get_http_session().get(url, timeout=HTTP_TIMEOUTS['tmdb']) as response:
+            if response.status != 200:
+                return None
+            data = await response.read()
+        if not data or len(data) > TELEGRAM_PHOTO_LIMIT:
+            return None
+        os.makedirs(POSTER_CACHE_DIR, exist_ok=True)
+        await asyncio.to_thread(write_file_atomic, path, data)
+        await asyncio.to_thread(trim_poster_cache)
+        return path
+    except Exception as e:
+        logger.error(f"خطا در دانلود پوستر {url}: {e}")
+        return None
+
+async def resolve_poster(movie_id, details):
+    # اولویت: file_id ذخیره شده، فایل محلی، آدرس TMDB با اندازه مناسب
+    # خروجی False یعنی پوستر قطعاً نامعتبر است و None یعنی فعلاً (خطای موقت) قابل بررسی نیست
+    file_id = store_get_poster_file_id(movie_id)
+    if file_id:
+        return {'file_id': file_id}
+    transient = False
+    for size in POSTER_SIZES:
+        url = f"{TMDB_IMAGE_BASE}/{size}{details['poster_path']}"
+        usable = await check_poster_url(url)
+        if usable is None:
+            transient = True
+        if not usable:
+            continue
+        if POSTER_PREFETCH:
+            path = await download_poster(movie_id, url)
+            if path:
+                return {'url': url, 'path': path}
+        return {'url': url}
+    return None if transient else False
+
+def read_poster_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+async def get_photo_input(movie_id, poster):
+    # file_id ممکن است پس از آماده‌سازی (مثلاً با پیش‌نمایش ادمین) ذخیره شده باشد
+    file_id = poster.get('file_id') or store_get_poster_file_id(movie_id)
+    if file_id:
+        return file_id
+    if poster.get('path') and os.path.exists(poster['path']):
+        # پوستر تا ۱۰ مگابایت است؛ خواندن در thread جداگانه تا event loop متوقف نشود
+        return await asyncio.to_thread(read_poster_file, poster['path'])
+    return poster['url']
+
+def remember_poster_file_id(movie_id, message):
+    if message and message.photo:
+        store_set_poster_file_id(movie_id, message.photo[-1].file_id)
+
+# ----------------- صف پست‌های آماده -----------------
+# خلاصه، کپشن و پوستر K پست بعدی هر کانال از قبل آماده می‌شوند تا post_movie_job فقط ارسال کند.
+
+async def prepare_post(movie_id):
+    details = movie_cache.get(movie_id)
     if not details or not details.get('poster_path'):
-        logger.error(f"جزئیات فیلم انتخاب شده {chosen_id} ناقص است. حذف و ادامه.")
-        del movie_cache[chosen_id]
-        await save_cache_to_file()
-        return
+        logger.error(f"جزئیات فیلم انتخاب شده {movie_id} ناقص است. حذف و ادامه.")
+        cache_remove_movie(movie_id)
+        return None
+
+    poster = await resolve_poster(movie_id, details)
+    if poster is None:
+        # فیلم در کش می‌ماند و فراخواننده آن را به مخزن کانال برمی‌گرداند تا در آماده‌سازی بعدی دوباره امتحان شود
+        logger.warning(f"بررسی پوستر فیلم {details['title']} فعلاً ممکن نیست. تلاش دوباره در آماده‌سازی بعدی.")
+        return None
+    if not poster:
+        logger.error(f"پوستر فیلم {details['title']} معتبر نیست. حذف و ادامه.")
+        reject_movie(movie_id, 'bad_poster')
+        cache_remove_movie(movie_id)
+        return None
 
-    # تولید خلاصه
+    # تولید خلاصه؛ اگر Gemini خلاصه نداد، خلاصه OMDB/TMDB فقط همین لحظه از دیتابیس خوانده می‌شود
     summary = await generate_summary(details['title'], details['year'])
+    caption_summary = summary
+    if not summary:
+        text = await load_movie_text(movie_id)
+        caption_summary = text.get('plot') or text.get('overview')
 
     # ساخت کپشن و دکمه
-    caption, reply_markup = build_movie_caption(details, summary)
+    caption, reply_markup, caption_summary = fit_movie_caption(details, caption_summary)
+    return {
+        'movie_id': movie_id,
+        'title': details['title'],
+        'poster': poster,
+        'caption': caption,
+        'reply_markup': reply_markup,
+        'has_summary': bool(summary and caption_summary),
+    }
+
+async def refill_post_queue(channel=None):
+    if channel is None:
+        for channel in channels:
+            await refill_post_queue(channel)
+        return
+    async with channel.prepare_lock:
+        # تکمیل خلاصه پست‌هایی که قبلاً به دلیل محدودیت Gemini بدون خلاصه آماده شده‌اند (در یک درخواست)
+        posts = [
+            post for post in channel.prepared
+            if not post['has_summary'] and post['movie_id'] in movie_cache
+        ]
+        if posts and GEMINI_MODEL and provider_available('gemini'):
+            details_list = [movie_cache[post['movie_id']] for post in posts]
+            summaries = await generate_summaries([(details['title'], details['year']) for details in details_list])
+            for post, details, summary in zip(posts, details_list, summaries):
+                if summary:
+                    post['caption'], post['reply_markup'], summary = fit_movie_caption(details, summary)
+                    post['has_summary'] = bool(summary)
+
+        while len(channel.prepared) < POST_LOOKAHEAD:
+            movie_ids = []
+            while len(channel.prepared) + len(movie_ids) < POST_LOOKAHEAD:
+                movie_id = pick_candidate(channel)
+                if movie_id is None:
+                    break
+                movie_ids.append(movie_id)
+            if not movie_ids:
+                break
+            # خلاصه همه فیلم‌های انتخاب شده در یک درخواست؛ prepare_post بعد از آن از کش خلاصه می‌خواند
+            await generate_summaries([
+                (movie_cache[movie_id]['title'], movie_cache[movie_id]['year'])
+                for movie_id in movie_ids if movie_id in movie_cache
+            ])
+            deferred = []
+            for movie_id in movie_ids:
+                post = await prepare_post(movie_id)
+                if post:
+                    channel.prepared.append(post)
+                elif movie_id in movie_cache:
+                    deferred.append(movie_id)
+            if deferred:
+                # خطای موقت (مثلاً CDN پوستر)؛ فیلم‌ها به مخزن برمی‌گردند و در اجرای بعدی دوباره امتحان می‌شوند
+                for movie_id in deferred:
+                    return_candidate(channel, movie_id)
+                break
+        logger.info(f"صف پست‌های آماده کانال {channel.name}: {len(channel.prepared)} از {POST_LOOKAHEAD}")
+
+@track_job('refill_post_queue')
+async def refill_post_queue_job(context: ContextTypes.DEFAULT_TYPE):
+    await refill_post_queue()
+
+@track_job('prewarm_summaries')
+async def prewarm_summaries_job(context: ContextTypes.DEFAULT_TYPE):
+    await prewarm_summaries()
+
+def take_prepared_post(channel):
+    while channel.prepared:
+        post = channel.prepared.popleft()
+        # ممکن است فیلم در این فاصله پست یا از کش حذف شده باشد
+        if post['movie_id'] in movie_cache and post['movie_id'] not in channel.posted:
+            return post
+    return None
+
+async def prepare_post_now(bot, channel):
+    # مسیر جایگزین وقتی صف پست‌های آماده خالی است
+    # انتخاب وزن‌دار از مخزن کانال
+    movie_id = pick_candidate(channel)
+
+    if movie_id is None:
+        # مخزن این کانال خالی است (ممکن است کش برای کانال‌های دیگر فیلم داشته باشد)؛ اول خزنده عمیق‌تر می‌رود
+        logger.warning(f"مخزن کانال {channel.name} خالی است. منتظر دریافت فیلم‌های جدید...")
+        # shield: لغو شدن این پست، دریافت مشترک را لغو نمی‌کند
+        refreshed = await asyncio.shield(start_background_refresh())
+        if not movie_cache and not refreshed:
+            await send_admin_alert(bot, "⚠️ کش فیلم‌ها خالی است و دریافت مجدد ناموفق بود.")
+            return None
+        movie_id = pick_candidate(channel)
+
+    if movie_id is None:
+        logger.warning(f"تمام فیلم‌های موجود برای کانال {channel.name} پست شده‌اند. کش را ریست می‌کنیم.")
+        await send_admin_alert(bot, f"🔄 تمام فیلم‌های موجود در کش برای کانال {channel.name} پست شدند. ریست کردن کش فیلم‌های پست شده.")
+        reset_posted(channel)
+        movie_id = pick_candidate(channel)
+        
+        if movie_id is None:
+            logger.error(f"کش کاملاً خالی است حتی پس از ریست (کانال {channel.name}).")
+            await send_admin_alert(bot, f"❌ کش فیلم‌ها برای کانال {channel.name} کاملاً خالی است.")
+            return None
+
+    post = await prepare_post(movie_id)
+    if post is None and movie_id in movie_cache:
+        return_candidate(channel, movie_id)
+    return post
+
+@track_job('post_movie')
+async def post_movie_job(context: ContextTypes.DEFAULT_TYPE):
+    # ... (توابع post_movie_job)
+    bot = context.bot
+    # کار زمان‌بندی شده کانال را در job.data دارد؛ در اجرای دستی: /post [نام کانال]
+    if context.job is not None:
+        channel = context.job.data
+    else:
+        channel = get_channel(context.args[0] if context.args else None)
+    if channel is None:
+        logger.error("کانالی برای ارسال پیدا نشد.")
+        return
+
+    post = take_prepared_post(channel)
+    if post is None:
+        logger.warning(f"صف پست‌های آماده کانال {channel.name} خالی است. آماده‌سازی در لحظه...")
+        post = await prepare_post_now(bot, channel)
+        if post is None:
+            return
     
-    # ارسال پیام
+    # ارسال پیام (از صف ارسال؛ اجرای دستی همزمان با کار زمان‌بندی شده همان پست را دوباره نمی‌فرستد)
     try:
-        poster_url = f"https://image.tmdb.org/t/p/original{details['poster_path']}"
-        
-        await bot.send_photo(
-            chat_id=CHANNEL_ID,
-            photo=poster_url,
-            caption=caption,
-            reply_markup=reply_markup,
+        message = await telegram_sender.send(
+            'send_photo', channel.chat_id, bot=bot, key=f"post:{channel.name}:{post['movie_id']}",
+            photo=await get_photo_input(post['movie_id'], post['poster']),
+            caption=post['caption'],
+            reply_markup=post['reply_markup'],
             parse_mode='Markdown'
         )
+        remember_poster_file_id(post['movie_id'], message)
         
-        posted_movies.add(chosen_id)
-        del movie_cache[chosen_id] # حذف از کش بعد از پست شدن
-        await save_posted_movies_to_file()
-        await save_cache_to_file()
-        logger.info(f"فیلم {details['title']} با موفقیت پست شد.")
+        mark_posted(channel, post['movie_id'])
+        record_posted_genres(channel, movie_cache.get(post['movie_id'], {}))
+        retire_posted_movie(post['movie_id']) # حذف از کش وقتی همه کانال‌های مرتبط پستش کرده باشند
+        post_results['sent'] += 1
+        logger.info(f"فیلم {post['title']} با موفقیت در کانال {channel.name} پست شد.")
         
+    except UncertainDelivery as e:
+        # ممکن است پست منتشر شده باشد؛ برای جلوگیری از پست تکراری پست شده حساب می‌شود
+        logger.error(f"پاسخ ارسال فیلم {post['title']} در کانال {channel.name} نرسید (احتمالاً ارسال شده): {e}")
+        await send_admin_alert(bot, f"⚠️ وضعیت ارسال فیلم {post['title']} در کانال {channel.name} نامشخص است؛ دوباره ارسال نمی‌شود.")
+        mark_posted(channel, post['movie_id'])
+        retire_posted_movie(post['movie_id'])
+        post_results['failed'] += 1
     except telegram.error.BadRequest as e:
         logger.error(f"خطای ارسال تلگرام (احتمالاً کپشن طولانی یا عکس نامعتبر): {e}")
-        await send_admin_alert(bot, f"❌ خطا در ارسال فیلم {details['title']}: {e}")
+        await send_admin_alert(bot, f"❌ خطا در ارسال فیلم {post['title']}: {e}")
+        post_results['failed'] += 1
+        # تلگرام همین پست را دوباره هم رد می‌کند؛ برگرداندن به مخزن فقط همان خطا را تکرار می‌کند
+        reject_movie(post['movie_id'], 'telegram_bad_request')
+        cache_remove_movie(post['movie_id'])
     except Exception as e:
         logger.error(f"خطای نامشخص در ارسال: {e}")
-        await send_admin_alert(bot, f"❌ خطای نامشخص در ارسال فیلم {details['title']}: {e}")
+        await send_admin_alert(bot, f"❌ خطای نامشخص در ارسال فیلم {post['title']}: {e}")
+        post_results['failed'] += 1
+        return_candidate(channel, post['movie_id'])
+    finally:
+        # آماده‌سازی پست بعدی در پس‌زمینه
+        context.application.create_task(refill_post_queue(channel))
+
+
+async def preview(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # پیش‌نمایش پست بعدی کانال برای ادمین: /preview [نام کانال] (پوستر آپلود شده بعداً در کانال دوباره آپلود نمی‌شود)
+    if update.effective_chat.id != int(ADMIN_ID):
+        await update.message.reply_text("شما ادمین نیستید.")
+        return
+    channel = get_channel(context.args[0] if context.args else None)
+    if channel is None:
+        await update.message.reply_text("کانالی با این نام تعریف نشده است.")
+        return
+    if not channel.prepared:
+        await refill_post_queue(channel)
+    if not channel.prepared:
+        await update.message.reply_text("پستی برای پیش‌نمایش آماده نیست.")
+        return
+    post = channel.prepared[0]
+    try:
+        message = await telegram_sender.send(
+            'send_photo', update.effective_chat.id, bot=context.bot,
+            photo=await get_photo_input(post['movie_id'], post['poster']),
+            caption=post['caption'],
+            reply_markup=post['reply_markup'],
+            parse_mode='Markdown'
+        )
+        remember_poster_file_id(post['movie_id'], message)
+    except Exception as e:
+        logger.error(f"خطا در ارسال پیش‌نمایش: {e}")
+        await update.message.reply_text(f"❌ خطا در ارسال پیش‌نمایش: {e}")
+
+# ----------------- افزودن فیلم‌ها (/addmovie) -----------------
+# ادمین فهرستی از نام/سال یا imdb_id (فایل CSV/متنی، متن پیام یا مسیر فایل روی سرور) می‌فرستد.
+# ردیف‌ها خط به خط در یک صف محدود ریخته می‌شوند و چند worker آن‌ها را با همان محدودیت نرخ و مدارشکن
+# سرویس‌ها پیدا و تکمیل می‌کنند؛ پیشرفت در یک پیام به‌روز می‌شود و ردیف‌های ناموفق در پایان گزارش می‌شوند.
+IMDB_ID_PATTERN = re.compile(r'\btt\d{7,}\b')
+TITLE_YEAR_PATTERN = re.compile(r'^(.*?)\s*(?:[,;]\s*|\(|\[)((?:18|19|20)\d{2})[)\]]?$') # Inception, 2010 یا The Matrix (1999)
+BARE_YEAR_PATTERN = re.compile(r'^(.*\S)\s+((?:18|19|20)\d{2})$') # Up 2009 (ولی Blade Runner 2049 هم همین شکل است)
+import_task = None
+
+def parse_import_row(line):
+    line = line.strip().lstrip('\ufeff')
+    if not line or line.startswith('#'):
+        return None
+    match = IMDB_ID_PATTERN.search(line)
+    if match:
+        return {'imdb_id': match.group()}
+    cells = [cell.strip() for cell in next(csv.reader([line]))]
+    if cells[0].casefold() in ('title', 'name', 'نام'):
+        return None # سطر عنوان فایل CSV
+    if len(cells) >= 2 and re.fullmatch(r'\d{4}', cells[1]):
+        return {'title': cells[0], 'year': cells[1]}
+    match = TITLE_YEAR_PATTERN.match(line)
+    if match:
+        return {'title': match.group(1).strip(), 'year': match.group(2)}
+    match = BARE_YEAR_PATTERN.match(line)
+    if match and int(match.group(2)) <= datetime.now().year + 2:
+        # عدد آخر ممکن است جزء نام باشد؛ اگر با سال پیدا نشد کل خط به عنوان نام جستجو می‌شود
+        return {'title': match.group(1), 'year': match.group(2), 'full_title': line}
+    return {'title': line, 'year': None}
+
+async def import_movie_row(row, seen, tmdb_semaphore, omdb_semaphore):
+    # خروجی: (وضعیت، دلیل) که وضعیت یکی از added، duplicate و failed است
+    if row.get('imdb_id'):
+        movie_id = resolve_identity(imdb_id=row['imdb_id'])
+        if movie_id and not movie_id.isdigit():
+            # imdb_id قدیمی تاریخچه پست که هنوز به شناسه TMDB وصل نشده
+            if is_posted_anywhere(movie_id):
+                return 'duplicate', 'قبلاً پست شده'
+            movie_id = None
+        movie_id = movie_id or await get_movie_id_from_imdb(row['imdb_id'])
+    else:
+        movie_id = await get_movie_id_from_tmdb(row['title'], row['year'])
+        if not movie_id and row.get('full_title'):
+            movie_id = await get_movie_id_from_tmdb(row['full_title'], None)
+    if not movie_id:
+        return 'failed', 'در TMDB پیدا نشد'
+    movie_id = str(movie_id)
+    if movie_id in seen:
+        return 'duplicate', 'تکراری در همین فهرست'
+    seen.add(movie_id)
+    if is_posted_anywhere(movie_id):
+        return 'duplicate', 'قبلاً پست شده'
+    if movie_id in movie_cache:
+        return 'duplicate', 'از قبل در کش است'
+    if movie_id in rejected_movies:
+        return 'failed', 'قبلاً رد شده (بدون imdb_id)'
+
+    details = await enrich_movie(movie_id, tmdb_semaphore, omdb_semaphore)
+    if details is DUPLICATE_MOVIE:
+        if is_posted_anywhere(movie_id):
+            return 'duplicate', 'قبلاً پست شده'
+        return 'duplicate', 'همان فیلم با شناسه TMDB دیگری موجود است'
+    if not details:
+        if movie_id in rejected_movies:
+            return 'failed', 'بدون imdb_id'
+        return 'failed', 'دریافت جزئیات ناموفق بود'
+    cache_put_movie(details['id'], details)
+    return 'added', None
+
+def format_import_progress(stats, done=False):
+    title = "✅ افزودن فیلم‌ها تمام شد" if done else "⏳ در حال افزودن فیلم‌ها"
+    return (
+        f"{title}\n"
+        f"ردیف‌های پردازش شده: {stats['rows']}\n"
+        f"اضافه شده: {stats['added']}\n"
+        f"تکراری: {stats['duplicate']}\n"
+        f"ناموفق: {stats['failed']}\n"
+        f"زمان: {time.monotonic() - stats['started']:.0f} ثانیه"
+    )
+
+async def import_movies(bot, chat_id, lines):
+    stats = {'rows': 0, 'added': 0, 'duplicate': 0, 'failed': 0, 'started': time.monotonic()}
+    failures = []
+    seen = set()
+    queue = asyncio.Queue(maxsize=IMPORT_CONCURRENCY * 4)
+    tmdb_semaphore = asyncio.Semaphore(TMDB_CONCURRENCY)
+    omdb_semaphore = asyncio.Semaphore(OMDB_CONCURRENCY)
+    progress = await telegram_sender.send('send_message', chat_id, bot=bot, text=format_import_progress(stats))
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            line_number, line, row = item
+            try:
+                status, reason = await import_movie_row(row, seen, tmdb_semaphore, omdb_semaphore)
+            except Exception as e:
+                logger.error(f"خطا در افزودن ردیف {line_number} ({line}): {e}")
+                status, reason = 'failed', f"خطا: {e}"
+            stats['rows'] += 1
+            stats[status] += 1
+            if status == 'failed':
+                failures.append((line_number, line, reason))
+
+    async def report_progress():
+        last_text = None
+        while True:
+            await asyncio.sleep(IMPORT_PROGRESS_INTERVAL)
+            text = format_import_progress(stats)
+            if text != last_text:
+                try:
+                    await telegram_sender.send('edit_message_text', chat_id, bot=bot, message_id=progress.message_id, text=text)
+                    last_text = text
+                except Exception as e:
+                    logger.warning(f"خطا در به‌روزرسانی پیام پیشرفت: {e}")
+
+    workers = [asyncio.create_task(worker()) for _ in range(IMPORT_CONCURRENCY)]
+    reporter = asyncio.create_task(report_progress())
+    try:
+        for line_number, line in enumerate(lines, 1):
+            row = parse_import_row(line)
+            if row:
+                # صف محدود است؛ خواندن فایل با سرعت پردازش ردیف‌ها جلو می‌رود
+                await queue.put((line_number, line.strip(), row))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        reporter.cancel()
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(reporter, *workers, return_exceptions=True)
+
+    logger.info(f"افزودن فیلم‌ها: {stats['added']} اضافه، {stats['duplicate']} تکراری، {stats['failed']} ناموفق.")
+    try:
+        await telegram_sender.send(
+            'edit_message_text', chat_id, bot=bot, message_id=progress.message_id, text=format_import_progress(stats, done=True)
+        )
+    except Exception as e:
+        logger.warning(f"خطا در به‌روزرسانی پیام پیشرفت: {e}")
+    if failures:
+        failures.sort()
+        lines = [f"{line_number}: {line} — {reason}" for line_number, line, reason in failures[:20]]
+        if len(failures) > 20:
+            lines.append(f"... و {len(failures) - 20} ردیف دیگر (فایل پیوست)")
+        await telegram_sender.send('send_message', chat_id, bot=bot, text="ردیف‌های ناموفق:\n" + "\n".join(lines))
+        if len(failures) > 20:
+            report = io.StringIO()
+            csv.writer(report).writerows([('line', 'row', 'reason'), *failures])
+            await telegram_sender.send(
+                'send_document', chat_id, bot=bot,
+                document=io.BytesIO(report.getvalue().encode('utf-8')),
+                filename='addmovie-failures.csv'
+            )
+    return stats
+
+async def read_import_lines(update, context):
+    # منبع فهرست: فایل پیوست (یا پیامی که به آن ریپلای شده)، مسیر فایل روی سرور یا متن خود پیام
+    message = update.message
+    document = message.document or (message.reply_to_message and message.reply_to_message.document)
+    if document:
+        telegram_file = await context.bot.get_file(document.file_id)
+        data = await telegram_file.download_as_bytearray()
+        return io.StringIO(bytes(data).decode('utf-8-sig', errors='replace'))
+    text = message.text or ''
+    text = text.split(None, 1)[1] if len(text.split(None, 1)) > 1 else ''
+    if text and '\n' not in text.strip() and os.path.isfile(text.strip()):
+        return open(text.strip(), 'r', encoding='utf-8-sig', errors='replace')
+    return io.StringIO(text) if text.strip() else None
+
+async def add_movie(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global import_task
+    if update.effective_chat.id != int(ADMIN_ID):
+        await update.message.reply_text("شما ادمین نیستید.")
+        return
+    if import_task and not import_task.done():
+        await update.message.reply_text("یک افزودن دیگر در حال اجراست. لطفاً صبر کنید.")
+        return
+    try:
+        lines = await read_import_lines(update, context)
+    except Exception as e:
+        logger.error(f"خطا در خواندن فهرست فیلم‌ها: {e}")
+        await update.message.reply_text(f"❌ خطا در خواندن فهرست: {e}")
+        return
+    if lines is None:
+        await update.message.reply_text(
+            "فهرست فیلم‌ها را بفرستید:\n"
+            "/addmovie Inception 2010\n"
+            "/addmovie tt0111161\n"
+            "/addmovie /path/to/movies.csv\n"
+            "یا یک فایل CSV/متنی با کپشن /addmovie (هر خط: نام و سال، یا imdb_id)"
+        )
+        return
+
+    async def run_import():
+        with lines:
+            await import_movies(context.bot, update.effective_chat.id, lines)
+
+    import_task = context.application.create_task(run_import())
+
+# ----------------- سرور HTTP (متریک، سلامت و webhook) -----------------
+async def metrics_handler(request):
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
 
+async def health_handler(request):
+    return web.json_response(get_health())
 
-async def run_bot():
+def create_web_app():
+    web_app = web.Application()
+    web_app.router.add_get('/metrics', metrics_handler)
+    web_app.router.add_get('/health', health_handler)
+    return web_app
+
+def get_webhook_path():
+    return urllib.parse.urlparse(WEBHOOK_URL).path or '/'
+
+def add_webhook_route(web_app, application):
+    # آپدیت‌های تلگرام مستقیم وارد صف Application می‌شوند؛ بدون Updater و حلقه Long Polling
+    async def webhook_handler(request):
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            logger.warning(f"درخواست webhook با توکن مخفی نامعتبر از {request.remote} رد شد.")
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except Exception as e:
+            logger.error(f"بدنه نامعتبر درخواست webhook: {e}")
+            return web.Response(status=400)
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response()
+
+    web_app.router.add_post(get_webhook_path(), webhook_handler)
+
+async def register_webhook(application):
+    # بعد از بالا آمدن سرور صدا زده می‌شود تا تلگرام از همان ابتدا به آن دسترسی داشته باشد
+    try:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True
+        )
+        logger.info(f"Webhook روی {WEBHOOK_URL} تنظیم شد.")
+        record_bot_ready('webhook')
+    except Exception as e:
+        logger.error(f"خطا در تنظیم Webhook: {e}")
+
+async def start_web_server(web_app):
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    logger.info(f"سرور HTTP روی پورت {PORT} شروع به کار کرد.")
+    return runner
+
+async def run_bot(web_app):
     """راه‌اندازی بات و زمان‌بندی کارها"""
-    if not TELEGRAM_TOKEN or not CHANNEL_ID or not ADMIN_ID:
-        logger.error("کلیدهای ضروری (TOKEN, CHANNEL_ID, ADMIN_ID) تنظیم نشده‌اند.")
+    if not TELEGRAM_TOKEN or not channels or not ADMIN_ID:
+        logger.error(f"کلیدهای ضروری (TOKEN, CHANNEL_ID یا {CHANNELS_FILE}, ADMIN_ID) تنظیم نشده‌اند.")
         return None
 
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    builder = Application.builder().token(TELEGRAM_TOKEN).base_url(f"{TELEGRAM_API_BASE}/bot")
+    if WEBHOOK_URL:
+        builder = builder.updater(None) # آپدیت‌ها از مسیر webhook روی سرور مشترک می‌رسند
+    application = builder.build()
+    telegram_sender.bot = application.bot # برای هشدارهایی که بات در دسترسشان نیست (مثلاً خطای Gemini)
     
-    # زمان‌بندی کارها (Long Polling)
-    application.job_queue.run_repeating(post_movie_job, interval=POST_INTERVAL, first=10) # اولین اجرا بعد از 10 ثانیه
-    application.job_queue.run_repeating(
-        lambda context: asyncio.create_task(fetch_movies_to_cache()), 
-        interval=FETCH_INTERVAL
-    )
+    # زمان‌بندی کارها
+    # هر کانال کار جداگانه دارد و زمان شروع‌ها پخش می‌شود تا ارسال‌ها همزمان نشوند
+    for channel, offset in zip(channels, channel_start_offsets()):
+        application.job_queue.run_repeating(
+            post_movie_job, interval=channel.interval, first=10 + offset, # اولین اجرا بعد از 10 ثانیه
+            data=channel, name=f"post:{channel.name}"
+        )
+    application.job_queue.run_repeating(fetch_movies_job, interval=FETCH_INTERVAL, first=FETCH_INTERVAL)
+    application.job_queue.run_repeating(refill_post_queue_job, interval=PREPARE_INTERVAL, first=5)
+    application.job_queue.run_repeating(prewarm_summaries_job, interval=SUMMARY_PREWARM_INTERVAL, first=120)
 
     # هندلرهای کامند
     application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("post", post_movie_job)) # اجرای دستی برای ادمین
+    application.add_handler(CommandHandler("post", post_movie_job)) # اجرای دستی برای ادمین: /post [نام کانال]
+    application.add_handler(CommandHandler("preview", preview)) # پیش‌نمایش پست بعدی برای ادمین: /preview [نام کانال]
+    application.add_handler(CommandHandler("addmovie", add_movie)) # افزودن فهرست فیلم‌ها: /addmovie [متن یا مسیر فایل]
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r'^/addmovie\b'), add_movie))
 
-    # راه‌اندازی Long Polling
+    await application.initialize()
     await application.start()
-    await application.updater.start_polling()
-    logger.info("بات با Long Polling شروع به کار کرد.")
+    if WEBHOOK_URL:
+        add_webhook_route(web_app, application)
+        logger.info(f"بات در حالت Webhook روی مسیر {get_webhook_path()} شروع به کار کرد.")
+    else:
+        # راه‌اندازی Long Polling
+        await application.updater.start_polling()
+        logger.info("بات با Long Polling شروع به کار کرد.")
+        record_bot_ready('polling')
     
     return application
 
 async def main():
+    global channels
     logger.info("شروع برنامه...")
-    await load_cache_from_file()
-    await load_posted_movies_from_file()
-    
-    # تمیزکاری posted_movies (حذف داده‌های غیرضروری)
-    cleaned_posted_movies = set()
-    for movie_id in posted_movies:
-        if isinstance(movie_id, str) and movie_id.startswith(('tt', '2')): # فرض: tmdb_id عددی و imdb_id با tt شروع می‌شود
-            cleaned_posted_movies.add(movie_id)
-    posted_movies.clear()
-    posted_movies.update(cleaned_posted_movies)
-
-    if not await fetch_movies_to_cache():
-        logger.error("خطا در دریافت اولیه لیست فیلم‌ها. ربات ممکن است با لیست خالی کار کند.")
+    channels = load_channels()
+    await load_cache_from_store()
+    await load_posted_movies_from_store()
+    await load_rejected_movies_from_store()
+    await load_identities_from_store()
+    await load_meta_from_store()
+    rebuild_candidate_pools()
+
+    if WARM_START:
+        # بات با داده‌های ذخیره شده شروع می‌شود و فیلم‌های جدید در پس‌زمینه اضافه می‌شوند
+        logger.info(f"شروع سریع با {len(movie_cache)} فیلم ذخیره شده؛ دریافت فیلم‌ها در پس‌زمینه.")
+        start_background_refresh()
+    else:
+        await refresh_movies()
     
-    # حذف Webhook قدیمی (فقط برای اطمینان در اجرای اول)
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/deleteWebhook",
-                json={"drop_pending_updates": True}
-            ) as response:
-                result = await response.json()
-                logger.info(f"ریست Webhook: {result}")
-    except Exception as e:
-        logger.error(f"خطا در ریست Webhook اولیه: {e}")
-        # await send_admin_alert(None, f"❌ خطا در ریست Webhook اولیه: {str(e)}") # حذف هشدار به ادمین در اجرای اولیه
+    if not WEBHOOK_URL:
+        # حذف Webhook قدیمی (فقط برای اطمینان در اجرای اول)
+        result = await post_api_request(
+            f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}/deleteWebhook",
+            json_data={"drop_pending_updates": True}
+        )
+        if result is not None:
+            logger.info(f"ریست Webhook: {result}")
+        else:
+            logger.error("خطا در ریست Webhook اولیه.")
+            # await send_admin_alert(None, f"❌ خطا در ریست Webhook اولیه: {str(e)}") # حذف هشدار به ادمین در اجرای اولیه
 
-    # راه‌اندازی بات
-    bot_app = await run_bot()
+    # راه‌اندازی بات (مسیر webhook قبل از شروع سرور به آن اضافه می‌شود)
+    web_app = create_web_app()
+    bot_app = await run_bot(web_app)
+
+    # سرور مشترک متریک/سلامت/webhook و پایش event loop
+    loop_monitor = asyncio.create_task(monitor_event_loop())
+    web_runner = await start_web_server(web_app)
+    if bot_app and WEBHOOK_URL:
+        await register_webhook(bot_app)
     
+    # Render بات را با SIGTERM متوقف می‌کند؛ خاموش شدن از همان مسیر finally می‌گذرد تا تغییرات در صف نوشته شوند
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass # ویندوز
     try:
-        # منتظر ماندن برای اجرای بی‌نهایت
-        while True:
-            await asyncio.sleep(3600)
-    except KeyboardInterrupt:
+        # منتظر ماندن تا سیگنال توقف
+        await stop_event.wait()
         logger.info("خاموش کردن بات...")
     finally:
+        # کارهای پس‌زمینه اول لغو می‌شوند (Application.stop منتظر import_task می‌ماند) و تا پایانشان صبر می‌کنیم
+        # تا قبل از بستن نشست HTTP و دیتابیس چیزی از آن‌ها استفاده نکند
+        background = [task for task in (refresh_task, import_task, *background_requests) if task and not task.done()]
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
         if bot_app and bot_app.updater and bot_app.updater.running:
             await bot_app.updater.stop()
         if bot_app and bot_app.running:
             await bot_app.stop()
         if bot_app:
             await bot_app.shutdown()
+        loop_monitor.cancel()
+        await web_runner.cleanup()
+        await close_http_session()
+        close_http_cache()
+        # نوشتن تغییرات باقی‌مانده قبل از بستن دیتابیس
+        await persistence_writer.flush()
+        close_store()
 
 
 if __name__ == '__main__':